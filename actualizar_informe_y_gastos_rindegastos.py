@@ -1,13 +1,18 @@
-import sys
+import argparse
 import pyodbc
 import requests 
 import pandas as pd
-import json 
 from sunatinfo_target_columns import sunatinfo_target_columns
-import datetime
+from df_utils import serialize_nested_columns
 from sqlalchemy import create_engine
-from cargar_rindegastos import fetch_and_store_extrafields_data, fetch_and_store_sunatinfo_data, log_exceptions
-import json
+from cargar_rindegastos import build_batch_frames, log_exceptions
+from load_coordinator import write_tables_concurrently
+from supplier_dimension import SUPPLIER_UPSERT_KEYS
+from profiling import stage, enable_profiling, write_profile_report
+from local_cache import lookup_report_id, update_report_index
+from detail_cache import detail_columns, build_detail_df, sync_expense_details, remove_expense_details
+from json_codec import loads
+from api_utils import request_with_retry, response_json, CircuitOpenException, RINDEGASTOS_POLICY, RINDEGASTOS_BREAKER, RINDEGASTOS_LIMITER
 from dotenv import load_dotenv
 import os
 
@@ -31,118 +36,111 @@ def get_database_connection():
     
     return pyodbc.connect(conn_str)
     
-# Function to transform lists and dictionaries to strings
-def transform_to_string(cell):
-    if isinstance(cell, (list, dict)):
-        return str(cell)
-    else:
-        return cell
-        
 # Custom function to convert ExtraFields
 def parse_extrafields(extra_fields):
     if isinstance(extra_fields, str):
-        return json.loads(extra_fields)
+        return loads(extra_fields)
     return extra_fields
         
-# Function to make GET requests to Rindegastos API with retry
+# Function to make GET requests to Rindegastos API with retry and backoff
 def fetch_from_rindegastos(endpoint, params=None):
     base_url = "https://api.rindegastos.com/v1/"
     headers = {"Authorization": f"Bearer {token}"}
     url = base_url + endpoint
 
-    for attempt in range(3):  # Make up to 3 attempts
-        # print(f"Attempting to fetch data from {url}, attempt {attempt + 1}...")
-        try:
-            response = requests.get(url, params=params, headers=headers)
-            response.raise_for_status()  # Raise an exception for HTTP errors
-            # print(f"Data successfully fetched on attempt {attempt + 1}")
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            # print(f"Error on attempt {attempt + 1}: {e}")
-            if attempt < 3:  # Wait 3 seconds before next attempt if not the last
-                print("Retrying immediately...")
-            else:
-                print("Failed to fetch data after 5 attempts.")
-                return None  # Return None after 5 failed attempts
+    # Timeouts, connection errors, 429 and 5xx responses are retried with backoff inside request_with_retry
+    try:
+        response = request_with_retry('GET', url, RINDEGASTOS_POLICY, RINDEGASTOS_BREAKER, RINDEGASTOS_LIMITER, params=params, headers=headers)
+        response.raise_for_status()  # Raise an exception for HTTP errors
+        return response_json(response)
+    except (requests.exceptions.RequestException, CircuitOpenException) as e:
+        print(f"Failed to fetch data from {url}: {e}")
+        return None
                 
-# Función para procesar el DataFrame y cargarlo en la base de datos
-def fetch_and_store_df(df, target_table, schema_name='fil', connection_string=''):    
-    if target_table == 'rindegastos_gastos': 
-        
-        # Extract Id and ExtraFields from the dataframe for separate processing and storage
-        extrafields_df = df[['Id', 'ExtraFields']].copy()
-        extrafields_df['ExtraFields'] = extrafields_df['ExtraFields'].apply(parse_extrafields)
-        
-        # Extract Id and SunatInfo from the dataframe for separate processing and storage
-        sunatinfo_df = df[['Id', 'SunatInfo']]
-        
-        try:
-            fetch_and_store_extrafields_data(extrafields_df, 'rindegastos_gastos_extrafields', "0")
-        except Exception as e:
-            print(f"Error in fetch_and_store_extrafields_data: {e}")
-        try:
-            fetch_and_store_sunatinfo_data(sunatinfo_df, 'rindegastos_gastos_sunatinfo', "0")
-        except Exception as e:
-            print(f"Error in fetch_and_store_sunatinfo_data: {e}")
-            
-    else:
-        # Extract Id and ExtraFields from the dataframe for separate processing and storage
-        extrafields_df = df[['Id', 'ExtraFields']].copy()
-        extrafields_df['ExtraFields'] = extrafields_df['ExtraFields'].apply(parse_extrafields)
-        
-        try:
-            fetch_and_store_extrafields_data(extrafields_df, 'rindegastos_informes_extrafields', '0')
-        except Exception as e:
-            print(f"Error in fetch_and_store_extrafields_data: {e}")
+# Función para obtener el Id de un informe a partir de su ReportNumber.
+# Se busca primero en el índice local (actualizado por la carga diaria y por cada actualización),
+# luego en rindegastos_informes y por último en la API, para informes que la carga diaria aún no ha visto.
+def resolve_report_id(report_number):
+    report_id = lookup_report_id(report_number)
+    if report_id is not None:
+        return report_id
 
-    engine = create_engine(connection_string)
-    
-    # Aplicar la transformación a cada elemento del DataFrame
-    df = df.map(transform_to_string)
-    
-    df.drop_duplicates(inplace=True)
+    try:
+        conn = get_database_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT TOP 1 Id FROM fil.rindegastos_informes WHERE ReportNumber = ?", report_number)
+        row = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        if row is not None:
+            report_id = row[0]
+    except Exception as e:
+        print(f"An error occurred while fetching the report Id: {e}")
+
+    if report_id is None:
+        reports_data = fetch_from_rindegastos("getExpenseReports", params={"ReportNumber": report_number})
+        if reports_data is not None:
+            report_id = next((report['Id'] for report in reports_data.get('ExpenseReports', []) if str(report.get('ReportNumber')) == str(report_number)), None)
+
+    if report_id is not None:
+        update_report_index([(report_number, report_id)])
+    return report_id
+
+# Función para preparar los DataFrames de la tabla principal y de sus tablas de extrafields y sunatinfo
+def build_table_frames(df, target_table):
+    if df.empty:
+        return {}
+    parsed_df = df.copy(deep=False)
+    parsed_df['ExtraFields'] = parsed_df['ExtraFields'].apply(parse_extrafields)
     
-    df['fecha_carga'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Serializar como JSON solo las columnas anidadas
+    stored_df = serialize_nested_columns(df)
+    stored_df = stored_df.drop_duplicates()
     
-    df.to_sql(target_table, engine, schema=schema_name, if_exists='append', index=False)
+    return build_batch_frames(parsed_df, stored_df, target_table)
+
+# Función para convertir un DataFrame en filas de parámetros para pyodbc (tipos de Python y None en lugar de NaN)
+def to_parameter_rows(df):
+    df = df.astype(object)
+    df = df.where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
     
 @log_exceptions
 def main(report_number):
+    # Step 1: Resolve the Id of the report from its ReportNumber
+    report_id = resolve_report_id(report_number)
+    if report_id is None:
+        raise Exception(f"Report with ReportNumber {report_number} not found")
+    
     # Connect to the database
     conn = get_database_connection()
     cursor = conn.cursor()
     
-    try:
-        # Step 1: Fetch ID from rindegastos_informes where ReportNumber is equal to report_number
-        cursor.execute(f"SELECT TOP 1 Id FROM fil.rindegastos_informes WHERE ReportNumber={report_number}")
-        report_id = cursor.fetchone()[0]
-        
-    except Exception as e:
-        print(f"An error occurred while fetching IDs: {e}")
-    
-    # Use fetch_from_rindegastos to get the expense report data
-    report_data = fetch_from_rindegastos("getExpenseReport", params={"Id": report_id})
-    if report_data is None:
-        raise Exception("Failed to fetch expense report data")
-        
-    # Create the Report DataFrame
-    report_df = pd.DataFrame([report_data])
+    with stage('fetch'):
+        # Use fetch_from_rindegastos to get the expense report data
+        report_data = fetch_from_rindegastos("getExpenseReport", params={"Id": report_id})
+        if report_data is None:
+            raise Exception("Failed to fetch expense report data")
+            
+        # Create the Report DataFrame
+        report_df = pd.DataFrame([report_data])
 
-    # Use fetch_from_rindegastos to get expenses related to the report
-    expenses_data = fetch_from_rindegastos("getExpenses", params={"ReportId": report_id})
-    if expenses_data is None:
-        raise Exception("Failed to fetch expenses data")
+        # Use fetch_from_rindegastos to get expenses related to the report
+        expenses_data = fetch_from_rindegastos("getExpenses", params={"ReportId": report_id})
+        if expenses_data is None:
+            raise Exception("Failed to fetch expenses data")
 
     # Extract expenses records and create the Expenses DataFrame
     records = expenses_data.get('Expenses', [])
     expenses_df = pd.DataFrame(records)
 
     # Expenses ID list. Aquí nos aseguramos de eliminar todo lo relacionado al informe. Incluyendo aquello gastos que pudieron ser elimnados 
+    # Se consulta siempre rindegastos_gastos: el caché local puede no tener los gastos cargados desde otro equipo
     try:
         # Step 1: Fetch Id from rindegastos_informes where ReportNumber is equal to report_number
         cursor.execute(f"SELECT Id FROM ciclo_proveedores.fil.rindegastos_gastos WHERE ReportId={report_id}")
         existing_expense_ids = [row[0] for row in cursor.fetchall()]
-        
+
     except Exception as e:
         print(f"An error occurred while fetching existing_expense_ids: {e}")
 
@@ -167,146 +165,93 @@ def main(report_number):
     # Connection string
     connection_string = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+17+for+SQL+Server"
 
-    # Procesar expenses_df
-    fetch_and_store_df(expenses_df, 'rindegastos_gastos', connection_string=connection_string)
+    # Procesar expenses_df y report_df. Las cinco tablas se escriben en paralelo y se confirman una vez escritas todas.
+    with stage('transform'):
+        frames = {
+            **build_table_frames(expenses_df, 'rindegastos_gastos'),
+            **build_table_frames(report_df, 'rindegastos_informes'),
+        }
+    with stage('load'):
+        write_tables_concurrently(frames, schema='fil', engine=create_engine(connection_string), upsert_keys=SUPPLIER_UPSERT_KEYS)
+    expense_extrafields_df = frames.get('rindegastos_gastos_extrafields')
 
-    # Procesar report_df con lógica especial
-    fetch_and_store_df(report_df, 'rindegastos_informes', connection_string=connection_string)
-
-    # Trasnformamos el dataframe en fila para obtener sus columnas con mayor facilidad
-    report_data =  report_df.iloc[0]
-
-    # Definimos los valores de las columnas que serán comunes para todos los gastos presentes en el informe
-    Aprobador = report_data.ApproverName
-    Informe_Estado = 'En Proceso' if report_data.Status == 0 else 'Cerrado' if report_data.Status == 1 else None
-    Informe_Estado_Interno = 'Contabilizado' if report_data.CustomStatus.strip() == 'Contabilizado' else 'No Contabilizado'
+    # El caché local queda con todos los gastos actuales del informe
+    sync_expense_details(expenses_df, expense_extrafields_df, complete_report_ids=[report_id])
 
-    # Definimos un dataframe con los valores de las columnas que deben ser actualizadas para los gastos en ciclo_proveedores.fil.reporte_rindegastos_detalle
-    conn = get_database_connection()
-    cursor = conn.cursor()
+    new_expense_ids = expenses_df['Id'].tolist() if 'Id' in expenses_df.columns else [] # Esta data viene directo de la API. 
 
-    try:
-        # Step 1: Fetch expense data that will be updated in table 
-        cursor.execute(f"""
-        SELECT 
-            rg.Id as ExpenseId,
-            rg.IssueDate AS Gasto_Fecha,
-            Serie_Value,
-            Correlativo_Value,
-            Category as Gasto_Categoria,
-            CategoryCode as Gasto_Cuenta_id, 
-            Centro_Costo_Code as Centro_costo_code,
-            Tipo_Documento_Value,
-            RUC_Proveedor_Value,
-            Supplier as Gasto_Proveedor,
-            Impuesto_Code,
-            case 
-                when rg.Status = 1 then 'Aprobado'
-                when rg.Status = 2 then 'Rechazado'
-                when rg.Status = 0 then 'En Proceso' 
-            end as Gasto_Estado,
-            Net as Gasto_Monto_neto, 
-            Tax as Gasto_Impuesto, 
-            OtherTaxes as Gasto_Otros_impuestos,
-            Total as Gasto_Monto_Total
-        FROM 
-            fil.rindegastos_gastos rg
-        LEFT JOIN 
-            fil.rindegastos_gastos_extrafields rge
-        ON 
-            rg.Id = rge.Id
-        WHERE 
-            rg.ReportId IN (
-                SELECT Id 
-                FROM fil.rindegastos_informes 
-                WHERE ReportNumber = {report_number}
-            );
-        """)
-        # Initialize an empty list to store dictionaries (rows)
-        rows = []
-        
-        # Fetch rows one by one and append as dictionaries
-        for row in cursor:
-            row_dict = {
-                'ExpenseId': row[0],
-                'Gasto_Fecha': row[1],
-                'Serie_Value': row[2],
-                'Correlativo_Value': row[3],
-                'Gasto_Categoria': row[4],
-                'Gasto_Cuenta_id': row[5],
-                'Centro_costo_code': row[6],
-                'Tipo_Documento_Value': row[7],
-                'RUC_Proveedor_Value': row[8],
-                'Gasto_Proveedor': row[9],
-                'Impuesto_Code': row[10],
-                'Gasto_Estado': row[11],
-                'Gasto_Monto_neto': row[12],
-                'Gasto_Impuesto': row[13],
-                'Gasto_Otros_impuestos': row[14],
-                'Gasto_Monto_Total': row[15]
-            }
-            rows.append(row_dict)
-        
-        # Convert list of dictionaries to DataFrame
-        cols_to_update_df = pd.DataFrame(rows)
-        
-    except Exception as e:
-        print(f"An error occurred while fetching the expenses: {e}")
+    # Find ExpenseIds that are in existing but not in new
+    # Existing expense ids viene de rindegastos_gastos (antes del DELETE)
+    expense_ids_to_delete = set(existing_expense_ids) - set(new_expense_ids)
+    remove_expense_details(expense_ids_to_delete)
 
-    new_expense_ids = expenses_df['Id'].tolist() # Esta data viene directo de la API. 
+    update_report_tables(report_df.iloc[0], report_number, expenses_df, expense_extrafields_df, expense_ids_to_delete)
 
-    # Convert to sets for easier comparison
-    existing_expense_ids_set = set(existing_expense_ids) # Existing expense ids viene de rindegastos_gastos (antes del DELETE)
-    new_expense_ids_set = set(new_expense_ids)
+# Función para actualizar en ciclo_proveedores.fil.reporte_rindegastos_detalle y reporte_rindegastos_resumen un informe
+# y sus gastos actuales, en lugar de ejecutar fil.sp_actualiza_reporte_rindegastos. report_data es el informe de la API,
+# expenses_df sus gastos, expense_extrafields_df los extrafields de esos gastos y expense_ids_to_delete los gastos que
+# ya no pertenecen al informe.
+def update_report_tables(report_data, report_number, expenses_df, expense_extrafields_df, expense_ids_to_delete):
+    # Definimos los valores de las columnas que serán comunes para todos los gastos presentes en el informe
+    Aprobador = report_data['ApproverName']
+    Informe_Estado = 'En Proceso' if report_data['Status'] == 0 else 'Cerrado' if report_data['Status'] == 1 else None
+    Informe_Estado_Interno = 'Contabilizado' if str(report_data['CustomStatus'] or '').strip() == 'Contabilizado' else 'No Contabilizado'
 
-    # Find ExpenseIds that are in existing but not in new
-    expense_ids_to_delete = existing_expense_ids_set - new_expense_ids_set
+    # Los valores a actualizar en ciclo_proveedores.fil.reporte_rindegastos_detalle se calculan directamente
+    # a partir de los gastos de la API y sus extrafields, sin volver a leerlos de la base de datos
+    with stage('transform'):
+        cols_to_update_df = build_detail_df(expenses_df, expense_extrafields_df) if not expenses_df.empty else pd.DataFrame(columns=list(detail_columns.values()))
 
-    # Esto es para obtener los ExpenseIds que existían previamente, para luego compararlos con los ExpenseIds del dataframe update_values.
-    # Si hay un ExpenseId que no se encuentre en los new_expense_ids debemos hacer DELETE FROM ciclo_proveedores.fil.reporte_rindegastos_detalle WHERE ExpenseId =   
+    # Si hay un ExpenseId que ya no pertenece al informe debemos hacer DELETE FROM ciclo_proveedores.fil.reporte_rindegastos_detalle WHERE ExpenseId =   
     try:
-        # Perform deletion for each ExpenseId that is no longer present
-        if expense_ids_to_delete:
-            delete_query = "DELETE FROM ciclo_proveedores.fil.reporte_rindegastos_detalle WHERE ExpenseId = ?"
-            conn = get_database_connection()
-            cursor = conn.cursor()
-            for expense_id in expense_ids_to_delete:
-                cursor.execute(delete_query, expense_id)
-                print(f"Deleted ExpenseId {expense_id}")
-            conn.commit()
-        
-        # Perform update for each ExpenseId present in cols_to_update_df
-        update_query = """UPDATE ciclo_proveedores.fil.reporte_rindegastos_detalle 
-                        SET Gasto_Fecha = ?, Serie_Value = ?, Correlativo_Value = ?, Gasto_Categoria = ?, Gasto_Cuenta_id = ?, Centro_costo_code = ?, Tipo_Documento_Value = ?, RUC_Proveedor_Value = ?, Gasto_Proveedor = ?, Impuesto_Code = ?, Gasto_Estado = ?, Gasto_Monto_neto = ?, Gasto_Impuesto = ?, Gasto_Otros_impuestos = ?, Gasto_Monto_Total = ?, Aprobador = ?, Informe_Estado = ?
-                        WHERE ExpenseId = ?"""
         conn = get_database_connection()
         cursor = conn.cursor()
+        cursor.fast_executemany = True
 
-        Gasto_Monto_neto = 0
-        Gasto_Impuesto = 0
-        Gasto_Monto_Total = 0
+        # Las tablas del reporte se actualizan en lugar de ejecutar fil.sp_actualiza_reporte_rindegastos
+        with stage('sp'):
+            # Perform deletion for each ExpenseId that is no longer present
+            if expense_ids_to_delete:
+                delete_query = "DELETE FROM ciclo_proveedores.fil.reporte_rindegastos_detalle WHERE ExpenseId = ?"
+                cursor.executemany(delete_query, [(int(expense_id),) for expense_id in expense_ids_to_delete])
+                print(f"Deleted ExpenseIds {sorted(expense_ids_to_delete)}")
+        
+            # Perform update for each ExpenseId present in cols_to_update_df
+            update_query = """UPDATE ciclo_proveedores.fil.reporte_rindegastos_detalle 
+                            SET Gasto_Fecha = ?, Serie_Value = ?, Correlativo_Value = ?, Gasto_Categoria = ?, Gasto_Cuenta_id = ?, Centro_costo_code = ?, Tipo_Documento_Value = ?, RUC_Proveedor_Value = ?, Gasto_Proveedor = ?, Impuesto_Code = ?, Gasto_Estado = ?, Gasto_Monto_neto = ?, Gasto_Impuesto = ?, Gasto_Otros_impuestos = ?, Gasto_Monto_Total = ?, Aprobador = ?, Informe_Estado = ?
+                            WHERE ExpenseId = ?"""
+            update_values = cols_to_update_df.drop(columns=['ExpenseId'])
+            update_values['Aprobador'] = Aprobador
+            update_values['Informe_Estado'] = Informe_Estado
+            update_values['ExpenseId'] = cols_to_update_df['ExpenseId']
+            if not update_values.empty:
+                cursor.executemany(update_query, to_parameter_rows(update_values))
+                print(f"Updated ExpenseIds {cols_to_update_df['ExpenseId'].tolist()}")
 
-        for index, row in cols_to_update_df.iterrows():
-            Gasto_Monto_neto += row['Gasto_Monto_neto']
-            Gasto_Impuesto += row['Gasto_Impuesto']
-            Gasto_Monto_Total += row['Gasto_Monto_Total']
-            cursor.execute(update_query, row['Gasto_Fecha'], row['Serie_Value'], row['Correlativo_Value'], row['Gasto_Categoria'], row['Gasto_Cuenta_id'], row['Centro_costo_code'], row['Tipo_Documento_Value'], row['RUC_Proveedor_Value'], row['Gasto_Proveedor'], row['Impuesto_Code'], row['Gasto_Estado'], row['Gasto_Monto_neto'], row['Gasto_Impuesto'], row['Gasto_Otros_impuestos'], row['Gasto_Monto_Total'], Aprobador, Informe_Estado, row['ExpenseId'])
-            print(f"Updated ExpenseId {row['ExpenseId']}")
+            # Totales del informe
+            Gasto_Monto_neto = float(cols_to_update_df['Gasto_Monto_neto'].sum())
+            Gasto_Impuesto = float(cols_to_update_df['Gasto_Impuesto'].sum())
+            Gasto_Monto_Total = float(cols_to_update_df['Gasto_Monto_Total'].sum())
 
-        update_query_resumen = """UPDATE ciclo_proveedores.fil.reporte_rindegastos_resumen 
-                                SET Aprobador = ?, Informe_Estado = ?, Informe_Estado_Interno = ?, Gasto_Monto_neto = ?, Gasto_Impuesto = ?, Gasto_Monto_Total = ?
-                                WHERE Informe_ID = ?"""
-        cursor.execute(update_query_resumen, Aprobador, Informe_Estado, Informe_Estado_Interno, Gasto_Monto_neto, Gasto_Impuesto, Gasto_Monto_Total, report_number)
-        conn.commit()
-        print(f"Updated Report with Informe_ID {report_number}")
+            update_query_resumen = """UPDATE ciclo_proveedores.fil.reporte_rindegastos_resumen 
+                                    SET Aprobador = ?, Informe_Estado = ?, Informe_Estado_Interno = ?, Gasto_Monto_neto = ?, Gasto_Impuesto = ?, Gasto_Monto_Total = ?
+                                    WHERE Informe_ID = ?"""
+            cursor.execute(update_query_resumen, Aprobador, Informe_Estado, Informe_Estado_Interno, Gasto_Monto_neto, Gasto_Impuesto, Gasto_Monto_Total, report_number)
+            conn.commit()
+            print(f"Updated Report with Informe_ID {report_number}")
 
     except Exception as e:
         print(f"An error occurred: {e}")
-    
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python actualizar_reporte_y_gastos_asociados.py <report_number>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Actualiza un informe de Rindegastos y sus gastos asociados")
+    parser.add_argument('report_number', type=int, help="ReportNumber del informe")
+    parser.add_argument('--profile', action='store_true', help="Guarda perfiles de CPU y memoria por etapa en PROFILE_DIR")
+    args = parser.parse_args()
 
-    report_number = int(sys.argv[1])
-    main(report_number)
\ No newline at end of file
+    if args.profile:
+        enable_profiling('actualizar_informe_y_gastos_rindegastos')
+    try:
+        main(args.report_number)
+    finally:
+        write_profile_report()
\ No newline at end of file
@@ -1,13 +1,239 @@
 ﻿import requests
 from dotenv import load_dotenv
 import os 
+import time
+import random
+import heapq
+import threading
+import datetime
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from json_codec import loads, DecodeError
+from profiling import profile_workers
+from params import API_MAX_RETRIES, API_BASE_DELAY, API_MAX_DELAY, API_REQUEST_TIMEOUT, API_CIRCUIT_FAILURES, API_CIRCUIT_RESET, RINDEGASTOS_MAX_CONCURRENCY, SUNAT_MAX_CONCURRENCY, API_TARGET_LATENCY
 
 load_dotenv()
 token = os.getenv('API_TOKEN')
 
+# Status codes that mean the server is throttling us or temporarily failing
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
 class APIAvailabilityException(Exception):
     pass
 
+# Function to decode the JSON body of a response through json_codec. Invalid JSON raises the same
+# requests.exceptions.JSONDecodeError as response.json(), so the existing error handling still applies.
+def response_json(response):
+    try:
+        return loads(response.content)
+    except DecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
+
+class CircuitOpenException(Exception):
+    pass
+
+# Function to read the Retry-After header (in seconds or as an HTTP date) of a response
+def parse_retry_after(response):
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# Exponential backoff with full jitter, honouring Retry-After when the server sends it
+class RetryPolicy:
+    def __init__(self, max_retries=API_MAX_RETRIES, base_delay=API_BASE_DELAY, max_delay=API_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt, response=None):
+        retry_after = parse_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+# Stops calling a service after repeated failures and lets a single trial request through after a pause
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=API_CIRCUIT_FAILURES, reset_timeout=API_CIRCUIT_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_progress:
+                raise CircuitOpenException(f"Circuit for {self.name} is open after {self.failures} consecutive failures")
+            self.trial_in_progress = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Opening circuit for {self.name} after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+# AIMD concurrency limit: grows by one request per round trip while latency is healthy,
+# and is halved when the service throttles (429) or fails (5xx, timeouts)
+class AdaptiveConcurrency:
+    def __init__(self, name, maximum, minimum=1, initial=2, target_latency=API_TARGET_LATENCY):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(max(self.minimum, min(initial, self.maximum)))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                # Decrease at most once per target latency, so a burst of errors counts as one signal
+                now = time.monotonic()
+                if now - self.last_decrease >= self.target_latency:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self.last_decrease = now
+                    print(f"Reducing {self.name} concurrency to {int(self.limit)}")
+            elif latency <= self.target_latency:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+# Retry policies, circuit breakers and concurrency limits shared by every call to each API
+RINDEGASTOS_POLICY = RetryPolicy()
+RINDEGASTOS_BREAKER = CircuitBreaker('Rindegastos')
+RINDEGASTOS_LIMITER = AdaptiveConcurrency('Rindegastos', RINDEGASTOS_MAX_CONCURRENCY)
+SUNAT_POLICY = RetryPolicy()
+SUNAT_BREAKER = CircuitBreaker('SUNAT')
+SUNAT_LIMITER = AdaptiveConcurrency('SUNAT', SUNAT_MAX_CONCURRENCY)
+
+# Function to release the limiter slot of a streamed response when it is closed, so the slot is held (and the
+# latency measured) until the body has been read. The caller must close the response.
+def release_on_close(response, limiter, start):
+    close = response.close
+    released = []
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                limiter.release(time.monotonic() - start, False)
+
+    response.close = close_and_release
+
+# Function to make an HTTP request retrying on timeouts, connection errors, 429 and 5xx responses.
+# Any other response is returned to the caller as is.
+def request_with_retry(method, url, policy, breaker=None, limiter=None, **kwargs):
+    kwargs.setdefault('timeout', API_REQUEST_TIMEOUT)
+    for attempt in range(policy.max_retries + 1):
+        if breaker is not None:
+            breaker.before_request()
+        if limiter is not None:
+            limiter.acquire()
+        start = time.monotonic()
+        response = None
+        error = None
+        try:
+            response = requests.request(method, url, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            error = e
+        finally:
+            failed = error is not None or (response is not None and response.status_code in RETRYABLE_STATUS_CODES)
+            if limiter is not None:
+                if kwargs.get('stream') and response is not None and not failed:
+                    release_on_close(response, limiter, start)
+                else:
+                    limiter.release(time.monotonic() - start, failed)
+
+        if not failed:
+            if breaker is not None:
+                breaker.record_success()
+            return response
+
+        if breaker is not None:
+            breaker.record_failure()
+        if attempt == policy.max_retries:
+            if error is not None:
+                raise error
+            return response
+
+        delay = policy.get_delay(attempt, response)
+        reason = error if error is not None else f"HTTP {response.status_code}"
+        if response is not None:
+            # Return the connection of the failed response to the pool before retrying
+            response.close()
+        print(f"Request to {url} failed ({reason}). Retrying in {delay:.1f} seconds...")
+        time.sleep(delay)
+
+# Function to apply func to every item using a thread pool bounded by an adaptive concurrency limit
+def run_concurrently(func, items, limiter):
+    with ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+        return list(executor.map(profile_workers(func), items))
+
+# Function to call func on the items in order of priority (the lowest value first), using up to limiter.maximum threads.
+# With a deadline (a time.monotonic() value) no item is started once the average duration of an item would not fit
+# before it. Returns the results of the processed items and the items that were left pending, both in priority order.
+def run_by_priority(func, items, priorities, limiter, deadline=None):
+    heap = [(priority, position, item) for position, (priority, item) in enumerate(zip(priorities, items))]
+    heapq.heapify(heap)
+    lock = threading.Lock()
+    results = []
+    durations = {'total': 0.0, 'count': 0}
+
+    def worker():
+        while True:
+            with lock:
+                if not heap:
+                    return
+                average = durations['total'] / durations['count'] if durations['count'] else 0
+                if deadline is not None and time.monotonic() + average > deadline:
+                    return
+                priority, position, item = heapq.heappop(heap)
+            start = time.monotonic()
+            result = func(item)
+            with lock:
+                durations['total'] += time.monotonic() - start
+                durations['count'] += 1
+                results.append((priority, position, result))
+
+    with ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+        for future in [executor.submit(profile_workers(worker)) for _ in range(limiter.maximum)]:
+            future.result()
+    pending = [item for _, _, item in sorted(heap)]
+    return [result for _, _, result in sorted(results, key=lambda entry: entry[:2])], pending
+
 def check_api_availability():
     url = "https://api.rindegastos.com/v1/getExpenses"
     headers = {"Authorization": f"Bearer {token}"}
@@ -16,7 +242,7 @@ def check_api_availability():
         response = requests.get(url, headers=headers)
         if response.status_code == 200:
             try:
-                response_data = response.json()
+                response_data = response_json(response)
 
                 if "Error" in response_data:
                     raise APIAvailabilityException(f"API returned an error: {response_data['Error']}")
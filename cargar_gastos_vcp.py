@@ -1,6 +1,6 @@
 import requests
-import json
 import time
+import argparse
 import numpy as np
 from datetime import datetime
 import pyodbc
@@ -8,10 +8,16 @@ import pandas as pd
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
 from dateutil.relativedelta import relativedelta
-from params import YEARS_OFFSET, MONTHS_OFFSET, DAYS_OFFSET
+from params import YEARS_OFFSET, MONTHS_OFFSET, DAYS_OFFSET, VCP_SKIP_RUC_STATES, VCP_SKIP_INACTIVE_SUPPLIERS, VCP_PRIORITY, VCP_DOCUMENT_PRIORITY, VCP_RECHECK_STATES, VCP_RECHECK_AFTER_DAYS, VCP_TIME_BUDGET_MINUTES
 import os
 from cargar_rindegastos import log_exceptions
+from json_codec import dumps_bytes, DecodeError
+from api_utils import request_with_retry, response_json, run_by_priority, CircuitOpenException, SUNAT_POLICY, SUNAT_BREAKER, SUNAT_LIMITER
 import requests.exceptions
+from profiling import stage, enable_profiling, write_profile_report
+from memory_utils import report_peak_rss
+from local_cache import get_ruc_statuses, update_ruc_statuses
+from change_log import record_changes, execute_report_refresh
 
 load_dotenv()
 
@@ -56,6 +62,9 @@ condDomiRuc_decode = {
     "20": "NO HALLADO"        # Not found
 }
 
+# Status recorded for the vouchers of inactive suppliers that are not sent to SUNAT
+SKIPPED_VOUCHER_STATUS = "NO CONSULTADO"
+
 # Function to consult the status
 def consultar_estado(rowId, numRuc, codComp, numeroSerie, numero, fechaEmision, monto):
     # URL for integrated consultation service
@@ -77,17 +86,18 @@ def consultar_estado(rowId, numRuc, codComp, numeroSerie, numero, fechaEmision,
         "monto": monto
     }
 
-    max_retries = 3
-    retries = 0
-    while retries < max_retries:
+    # Timeouts, connection errors, 429 and 5xx responses are retried with backoff inside request_with_retry.
+    # The voucher is only sent again, once, when SUNAT rejects the 'monto' of a physical voucher.
+    monto_error = "En comprobantes físicos, el campo 'monto' no debe registrar información"
+    for _ in range(2):
         try:
             print("--------------------------------------------------------------------------------------")
-            print(f"Processing rowId={rowId}, numRuc={numRuc}, codComp={codComp}, numeroSerie={numeroSerie}, numero={numero}, fechaEmision={fechaEmision}, monto={monto}") 
-            response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=10)
+            print(f"Processing rowId={rowId}, numRuc={numRuc}, codComp={codComp}, numeroSerie={numeroSerie}, numero={numero}, fechaEmision={fechaEmision}, monto={payload['monto']}") 
+            response = request_with_retry('POST', url, SUNAT_POLICY, SUNAT_BREAKER, SUNAT_LIMITER, headers=headers, data=dumps_bytes(payload), timeout=10)
             
             if response.status_code == 200:
                 # Successful request
-                response_data = response.json()
+                response_data = response_json(response)
                 if response_data.get("data"):
                     try:
                         estadoCp_text = estadoCp_decode[response_data["data"]["estadoCp"]]
@@ -106,29 +116,43 @@ def consultar_estado(rowId, numRuc, codComp, numeroSerie, numero, fechaEmision,
                     print(response.text)
             else:
                 try:
-                    error_message = response.json().get("message", "Error: Sunat API could not retrieve the data")
+                    error_message = response_json(response).get("message", "Error: Sunat API could not retrieve the data")
                     if error_message == "Error: Sunat API could not retrieve the data":
                         print(response.text)
                     else:
                         print("API warning: ", error_message)
-                    if error_message == "En comprobantes físicos, el campo 'monto' no debe registrar información":
+                    if error_message == monto_error and payload['monto'] != '':
                         payload['monto'] = ''
-                except (TypeError, json.JSONDecodeError):
+                        continue
+                except (TypeError, DecodeError):
                     print("Error: Unable to parse response text")
                     print(response.text)
 
+        except CircuitOpenException as e:
+            print(f"Error: {e}")
         except requests.exceptions.Timeout:
-            print("Error: Request timed out. Retrying...")
+            print("Error: Request timed out.")
         except requests.exceptions.ConnectionError:
-            print("Error: Network problem (e.g., DNS failure, refused connection). Retrying...")
+            print("Error: Network problem (e.g., DNS failure, refused connection).")
         except requests.exceptions.HTTPError as e:
             print(f"HTTP Error: {e}")
         except requests.exceptions.RequestException as e:
             print(f"Unexpected request error: {e}")
 
-        print('Retrying ... ')
-        time.sleep(1)
-        retries += 1        
+        # The voucher is not recorded, so the next run validates it again
+        return None
+
+# Function to build the priority of each voucher from the criteria of VCP_PRIORITY (the lowest value is validated first).
+# Vouchers of suppliers known to be inactive always go last.
+def build_priorities(df):
+    criteria = {
+        'inactivos': df['Inactive'].astype(int),
+        'nuevos': df['Recheck'].astype(int),
+        'fecha': -pd.to_datetime(df['IssueDate']).map(datetime.toordinal),
+        'monto': -pd.to_numeric(df['OriginalAmount'], errors='coerce').fillna(0),
+        'tipo': df['Tipo_Documento_Code'].map(VCP_DOCUMENT_PRIORITY).fillna(len(VCP_DOCUMENT_PRIORITY)),
+    }
+    return list(zip(*[criteria[criterion].tolist() for criterion in ['inactivos'] + VCP_PRIORITY])) if len(df) else []
 
 # Function to establish the database connection
 def get_database_connection():
@@ -143,7 +167,7 @@ def get_database_connection():
 
 # Function to drop any duplicates from the target table
 def drop_any_duplacates():
-    # Drop any duplicates 
+    # Drop any duplicates, keeping the latest validation of each voucher (a recheck adds a second row for its Id)
     conn = get_database_connection()
     cursor = conn.cursor()
     try:
@@ -156,12 +180,8 @@ def drop_any_duplacates():
                 FROM 
                     ciclo_proveedores.fil.rindegastos_gastos_vcp
             )
-            DELETE FROM ciclo_proveedores.fil.rindegastos_gastos_vcp
-            WHERE Id IN (
-                SELECT Id 
-                FROM CTE 
-                WHERE rn > 1
-            );
+            DELETE FROM CTE
+            WHERE rn > 1;
         ''')
         conn.commit()
         print(f"Duplicates removed from table ciclo_proveedores.fil.rindegastos_gastos_vcp")
@@ -175,6 +195,7 @@ def drop_any_duplacates():
 def main():
     global token
     start_time = time.time()
+    start_monotonic = time.monotonic()
 
     # Replace these values with your actual client_id and client_secret
     client_id = os.getenv('CLIENT_ID')
@@ -198,7 +219,7 @@ def main():
     # Checking the response status
     if response.status_code == 200:
         # Successful request
-        token = response.json().get("access_token")
+        token = response_json(response).get("access_token")
     else:
         # Error occurred
         print("Error:", response.text)
@@ -221,14 +242,25 @@ def main():
 
     # Define the SQL query to get checked_ids
     checked_ids_query = """
-    SELECT Id FROM CICLO_PROVEEDORES.fil.rindegastos_gastos_vcp;
+    SELECT Id, Estado_Comprobante, Fecha_Consulta FROM CICLO_PROVEEDORES.fil.rindegastos_gastos_vcp;
     """
 
-    # Load checked_ids into a pandas DataFrame
-    checked_ids_df = pd.read_sql_query(checked_ids_query, cnxn)
+    with stage('fetch'):
+        # Load checked_ids into a pandas DataFrame
+        checked_ids_df = pd.read_sql_query(checked_ids_query, cnxn)
+        # Only the latest validation of each voucher counts, in case drop_any_duplacates did not run after a recheck
+        checked_ids_df = checked_ids_df.sort_values('Fecha_Consulta').drop_duplicates(subset='Id', keep='last')
+
+        # Vouchers checked before in one of VCP_RECHECK_STATES, and those skipped for an inactive supplier, are
+        # validated again after VCP_RECHECK_AFTER_DAYS days
+        recheck = (
+            checked_ids_df['Estado_Comprobante'].isin(VCP_RECHECK_STATES + [SKIPPED_VOUCHER_STATUS])
+            & (pd.to_datetime(checked_ids_df['Fecha_Consulta']) < datetime.now() - relativedelta(days=VCP_RECHECK_AFTER_DAYS))
+        )
+        recheck_ids = set(checked_ids_df.loc[recheck, 'Id'])
 
-    # Extract the 'Id' column as a list or set
-    checked_ids = set(checked_ids_df['Id'])
+        # Extract the 'Id' column as a list or set
+        checked_ids = set(checked_ids_df['Id']) - recheck_ids
 
     # Define the main SQL query to load data into df
     main_query = f"""
@@ -250,24 +282,46 @@ def main():
         a.IssueDate >= '{reference_date}';
     """
 
-    # Load data into a pandas DataFrame
-    df = pd.read_sql_query(main_query, cnxn)
-
-    # Drop rows with any NaN values
-    df.dropna(how='any', inplace=True)
-
-    # Apply transformation
-    df['Serie_Value'] = df['Serie_Value'].apply(lambda x: x.split('-')[0])
-
-    # Filter rows where Tipo_Documento_Code is either 'FAC' or 'BOL'
-    df = df[df['Tipo_Documento_Code'].isin(['FAC', 'BOL'])]
-
-    # Drop rows from df where 'Id' is in checked_ids
-    df = df[~df['Id'].isin(checked_ids)]
-
-    # Apply consultar_estado function and create a new DataFrame
-    rinde_gastos_vcp = []
-    for index, row in df.iterrows():
+    with stage('fetch'):
+        # Load data into a pandas DataFrame
+        df = pd.read_sql_query(main_query, cnxn)
+
+    with stage('transform'):
+        # Drop rows with any NaN values
+        df.dropna(how='any', inplace=True)
+
+        # Apply transformation
+        df['Serie_Value'] = df['Serie_Value'].apply(lambda x: x.split('-')[0])
+
+        # Filter rows where Tipo_Documento_Code is either 'FAC' or 'BOL'
+        df = df[df['Tipo_Documento_Code'].isin(['FAC', 'BOL'])]
+
+        # Drop rows from df where 'Id' is in checked_ids
+        df = df[~df['Id'].isin(checked_ids)]
+        df = df.assign(Recheck=df['Id'].isin(recheck_ids))
+
+        # Taxpayer status of the suppliers learned from previous validations (within RUC_STATUS_TTL_HOURS)
+        ruc_statuses = get_ruc_statuses()
+        inactive_rucs = {ruc for ruc, statuses in ruc_statuses.items() if set(statuses) & set(VCP_SKIP_RUC_STATES)}
+        df = df.assign(Inactive=df['RUC_Proveedor_Value'].astype(str).isin(inactive_rucs))
+        skipped_vcp = []
+        if VCP_SKIP_INACTIVE_SUPPLIERS:
+            # They are recorded with the cached status of the supplier, so they are not validated again until
+            # VCP_RECHECK_AFTER_DAYS days have passed
+            print(f"Skipping {int(df['Inactive'].sum())} vouchers of suppliers in {', '.join(VCP_SKIP_RUC_STATES)}")
+            for row_id, num_ruc in df.loc[df['Inactive'], ['Id', 'RUC_Proveedor_Value']].itertuples(index=False):
+                estado_contribuyente, condicion_domiciliaria = ruc_statuses[str(num_ruc)]
+                skipped_vcp.append({"Id": row_id,
+                                    "Fecha_Consulta": datetime.now(),
+                                    "Estado_Comprobante": SKIPPED_VOUCHER_STATUS,
+                                    "Estado_Contribuyente": estado_contribuyente,
+                                    "Condicion_Domiciliaria": condicion_domiciliaria
+                                   })
+            df = df[~df['Inactive']]
+
+    # Apply consultar_estado function and create a new DataFrame.
+    # Validations run concurrently, bounded by the adaptive concurrency limit of the SUNAT API.
+    def validar_comprobante(row):
         # Values to be passed to consultar_estado
         row_id = row['Id']
         num_ruc = row["RUC_Proveedor_Value"]
@@ -285,41 +339,67 @@ def main():
                                   fecha_emision, 
                                   monto)
         if result:
-            rinde_gastos_vcp.append({"Id": row["Id"], 
-                                     "Fecha_Consulta": datetime.now(), 
-                                     "Estado_Comprobante": result[0], 
-                                     "Estado_Contribuyente": result[1], 
-                                     "Condicion_Domiciliaria": result[2]
-                                    })
+            estado_contribuyente, condicion_domiciliaria = result[1], result[2]
+            if pd.isna(estado_contribuyente):
+                # SUNAT only returns the status of the supplier for existing vouchers; reuse the one learned for the RUC
+                estado_contribuyente, condicion_domiciliaria = ruc_statuses.get(str(num_ruc), (np.nan, np.nan))
+            else:
+                ruc_statuses[str(num_ruc)] = (estado_contribuyente, condicion_domiciliaria)
+                learned_statuses.append((num_ruc, estado_contribuyente, condicion_domiciliaria))
+            return {"Id": row["Id"], 
+                    "Fecha_Consulta": datetime.now(), 
+                    "Estado_Comprobante": result[0], 
+                    "Estado_Contribuyente": estado_contribuyente, 
+                    "Condicion_Domiciliaria": condicion_domiciliaria
+                   }
+
+    # The most important vouchers are validated first, and no validation starts once the time budget is spent.
+    # The vouchers left pending are not recorded, so the next run picks them up.
+    deadline = start_monotonic + VCP_TIME_BUDGET_MINUTES * 60 if VCP_TIME_BUDGET_MINUTES else None
+    learned_statuses = []
+    with stage('fetch'):
+        results, pending = run_by_priority(
+            validar_comprobante,
+            [row for _, row in df.iterrows()],
+            build_priorities(df),
+            SUNAT_LIMITER,
+            deadline,
+        )
+    update_ruc_statuses(learned_statuses)
+    if pending:
+        print(f"Time budget of {VCP_TIME_BUDGET_MINUTES} minutes reached: {len(pending)} vouchers left for the next run")
+    rinde_gastos_vcp = [result for result in results if result] + skipped_vcp
 
     rinde_gastos_vcp_df = pd.DataFrame(rinde_gastos_vcp)
     connection_string = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+17+for+SQL+Server"
     engine = create_engine(connection_string)
     target_table = 'rindegastos_gastos_vcp'
 
-    if not rinde_gastos_vcp_df.empty:
-        rinde_gastos_vcp_df.to_sql(target_table, engine, schema=schema_name, if_exists='append', index=False)
-    else:
-        print("DataFrame is empty; table not replaced.")
+    with stage('load'):
+        if not rinde_gastos_vcp_df.empty:
+            rinde_gastos_vcp_df.to_sql(target_table, engine, schema=schema_name, if_exists='append', index=False)
+            record_changes(target_table, rinde_gastos_vcp_df['Id'], 'I')
+        else:
+            print("DataFrame is empty; table not replaced.")
 
-    drop_any_duplacates()
+        drop_any_duplacates()
 
-    # Add EXEC statement at the end
-    try:
-        conn = get_database_connection()
-        cursor = conn.cursor()
-        cursor.execute(f"EXEC fil.sp_actualiza_reporte_rindegastos")  # Replace with your actual stored procedure
-        conn.commit()
-    except Exception as e:
-        print(f"Error executing stored procedure: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    # Refresh the reporting tables with the vouchers validated in this run
+    execute_report_refresh()
 
     end_time = time.time()
     execution_time = end_time - start_time
     print(f"Execution time: {execution_time} seconds")
+    report_peak_rss('cargar_gastos_vcp')
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Valida en SUNAT los comprobantes de los gastos de Rindegastos")
+    parser.add_argument('--profile', action='store_true', help="Guarda perfiles de CPU y memoria por etapa en PROFILE_DIR")
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling('cargar_gastos_vcp')
+    try:
+        main()
+    finally:
+        write_profile_report()
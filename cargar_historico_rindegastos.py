@@ -0,0 +1,90 @@
+import os
+import time
+import argparse
+from cargar_rindegastos import (
+    log_exceptions, fetch_and_store_data, get_expenses, get_expense_reports,
+    delete_rindegastos_gastos, delete_rindegastos_informes, drop_any_duplacates,
+)
+from api_utils import check_api_availability
+from db_utils import get_database_connection
+from run_lease import run_with_lease
+from partition_planner import plan_partitions, run_partitions, parse_date
+from local_cache import get_completed_backfill_units, mark_backfill_unit_completed, clear_backfill_units
+from change_log import execute_report_refresh
+from change_detection import ensure_tracking_tables
+from dotenv import load_dotenv
+from params import INCREMENTAL_LOAD, REPORT_REFRESH_MODE, PARTITION_WORKERS
+
+load_dotenv()
+
+# Loads the approved expenses and reports of an arbitrary date range, one calendar month at a time.
+# Each month and entity is a unit whose completion is saved in the local cache, so an interrupted backfill
+# only loads the units that did not finish. The daily run (cargar_rindegastos.py) is not affected.
+ENTITIES = {
+    'gastos': ('rindegastos_gastos', 'Expenses', get_expenses, delete_rindegastos_gastos),
+    'informes': ('rindegastos_informes', 'ExpenseReports', get_expense_reports, delete_rindegastos_informes),
+}
+
+# Function to get the name of the lease and checkpoint namespace of a backfill: the same range is never loaded
+# twice at the same time, and its pages never share a checkpoint with the daily run
+def backfill_name(desde, hasta):
+    return f"cargar_historico_rindegastos:{desde}:{hasta}"
+
+# Function to build the key of a unit of the backfill
+def unit_key(entity, partition):
+    return f"{entity}:{partition.since}:{partition.until}:{partition.status}"
+
+# Returns True when every unit was loaded, so the run lease records whether the backfill succeeded
+@log_exceptions
+def main(desde, hasta, workers=PARTITION_WORKERS, restart=False):
+    if not check_api_availability():
+        return False
+    start_time = time.time()
+    token = os.getenv('API_TOKEN')
+
+    # Only approved records: the daily run keeps the other statuses within its own window
+    partitions, _ = plan_partitions(['1'], desde, hasta, refresh_all=True, months=1, recent_days=0)
+    units = [(entity, partition) for entity in ENTITIES for partition in partitions]
+    if restart:
+        clear_backfill_units([unit_key(entity, partition) for entity, partition in units])
+    completed_units = get_completed_backfill_units()
+    pending_units = [(entity, partition) for entity, partition in units if unit_key(entity, partition) not in completed_units]
+    print(f"Backfill from {desde} to {hasta}: {len(units) - len(pending_units)} of {len(units)} units already completed")
+
+    if INCREMENTAL_LOAD:
+        # The hash and change-log tables are created before the units write concurrently
+        ensure_tracking_tables()
+
+    def load_unit(unit):
+        entity, partition = unit
+        target_table, data_key, endpoint, delete_function = ENTITIES[entity]
+        if not INCREMENTAL_LOAD:
+            # Only the approved records of the month are reloaded, so the other statuses are kept
+            delete_function(partition.since, partition.until, partition.status)
+        loaded = fetch_and_store_data(lambda params: endpoint(params, token), target_table, data_key, partition.status, partition.since, partition.until, backfill_name(desde, hasta))
+        if loaded:
+            mark_backfill_unit_completed(unit_key(entity, partition))
+        return loaded
+
+    results = run_partitions(load_unit, pending_units, workers)
+    failed_units = [unit_key(entity, partition) for (entity, partition), loaded in results.items() if not loaded]
+
+    drop_any_duplacates()
+    execute_report_refresh(mode=REPORT_REFRESH_MODE if INCREMENTAL_LOAD else 'full')
+
+    if failed_units:
+        print(f"{len(failed_units)} units failed and will be retried in the next run: {failed_units}")
+    print(f"Execution time: {time.time() - start_time} seconds")
+    return not failed_units
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carga histórica de gastos e informes de Rindegastos por meses")
+    parser.add_argument('--desde', required=True, type=lambda value: parse_date(value).isoformat(), help="Fecha inicial (YYYY-MM-DD)")
+    parser.add_argument('--hasta', required=True, type=lambda value: parse_date(value).isoformat(), help="Fecha final, incluida (YYYY-MM-DD)")
+    parser.add_argument('--workers', type=int, default=PARTITION_WORKERS, help="Meses que se cargan en paralelo")
+    parser.add_argument('--reiniciar', action='store_true', help="Vuelve a cargar también los meses ya completados")
+    args = parser.parse_args()
+
+    if args.desde > args.hasta:
+        parser.error("--desde debe ser anterior o igual a --hasta")
+    run_with_lease(backfill_name(args.desde, args.hasta), main, get_database_connection, args.desde, args.hasta, args.workers, args.reiniciar)
@@ -1,21 +1,34 @@
 ﻿import time
-from api_utils import check_api_availability
-import json
+import requests
+from api_utils import check_api_availability, request_with_retry, run_concurrently, RINDEGASTOS_POLICY, RINDEGASTOS_BREAKER, RINDEGASTOS_LIMITER
 import pandas as pd
-from sqlalchemy import create_engine
 import datetime
-import unicodedata
 import numpy as np
-import pyodbc
 import functools
+import argparse
 import traceback
-import requests
-from socket import timeout
 import os
 from sunatinfo_target_columns import sunatinfo_target_columns
+from df_utils import serialize_nested_columns, apply_schema, memory_report
+from schemas import get_schema
+from transform_utils import run_transform, parse_sunatinfo_records, parse_extrafields_records
+from checkpoint_utils import PageCheckpoint, remove_stale_checkpoints
+from db_utils import get_database_connection
+from load_coordinator import write_tables_concurrently
+from run_lease import run_with_lease
+from change_log import CHANGE_TABLE, build_batch_changes, record_changes, execute_report_refresh
+from supplier_dimension import SUPPLIER_TABLE, SUPPLIER_KEY, SUPPLIER_UPSERT_KEYS, split_sunatinfo_df, filter_changed_suppliers
+from json_codec import DecodeError
+from stream_records import StreamedPage, STREAM_CHUNK_SIZE, to_compact_records, build_frame
+from memory_utils import MemoryBudget, iter_record_batches, report_peak_rss
+from profiling import stage, enable_profiling, write_profile_report
+from partition_planner import plan_partitions, run_partitions, successful_slices, next_day
+from change_detection import HASH_COLUMN, RELATED_TABLES, compute_record_hashes, filter_changed_records, delete_records, store_hashes, find_missing_ids, find_missing_hashed_ids, register_seen_ids, compute_payload_fingerprint, ensure_tracking_tables
+from local_cache import get_fingerprint, set_fingerprint, update_report_index
+from detail_cache import sync_expense_details, remove_expense_details, prune_detail_cache
 from dotenv import load_dotenv
 from dateutil.relativedelta import relativedelta
-from params import YEARS_OFFSET, MONTHS_OFFSET, DAYS_OFFSET
+from params import YEARS_OFFSET, MONTHS_OFFSET, DAYS_OFFSET, INCREMENTAL_LOAD, DELETE_MISSING_RECORDS, MEMORY_REPORT, REFERENCE_TABLES, REFERENCE_TABLES_TTL_HOURS, SUNAT_SUPPLIER_DIMENSION, REPORT_REFRESH_MODE
 
 load_dotenv()
 
@@ -33,16 +46,6 @@ reference_date = (datetime.datetime.now() - relativedelta(
     days=DAYS_OFFSET,
 )).strftime("%Y-%m-%d")
 
-# Function to establish the database connection
-def get_database_connection():
-    conn_str = (
-        'DRIVER={SQL Server};SERVER=' + server +
-        ';DATABASE=' + database +
-        ';UID=' + '{' + username + '}' +
-        ';PWD=' + '{' + password + '}'
-    )
-    return pyodbc.connect(conn_str)
-
 # Decorator function to log exceptions and successes into the database
 def log_exceptions(func):
     @functools.wraps(func)
@@ -76,264 +79,277 @@ def log_exceptions(func):
                 input("An error occurred. Press Enter to exit.")
     return wrapper
 
-# Function to transform lists and dictionaries to strings
-def transform_to_string(cell):
-    if isinstance(cell, (list, dict)):
-        return str(cell)
-    else:
-        return cell
-
-def remove_accents_and_spaces(input_str):
-    nfkd_form = unicodedata.normalize('NFKD', input_str)
-    without_accents = ''.join([c for c in nfkd_form if not unicodedata.combining(c)])
-    return without_accents.replace(' ', '_')
-
-def fetch_and_store_sunatinfo_data(sunatinfo_df, target_table, status="1"):
-    data_keys = set()
-    nested_data_keys = set()
-    
-    for index, row in sunatinfo_df.iterrows():
-        sunat_info = row['SunatInfo']
-        if isinstance(sunat_info, dict):
-            data_keys.update(sunat_info.keys())
-            if 'extractedData' in sunat_info:
-                try:
-                    json_string = sunat_info['extractedData']
-                    extracted_data = json.loads(json_string)
-                    if isinstance(extracted_data, dict):
-                        nested_data_keys.update(extracted_data.keys())
-                    else:
-                        extracted_data = json.loads(extracted_data)['data']
-                        nested_data_keys.update(extracted_data.keys())
-                except Exception as e:
-                    print(f"Error processing 'extractedData': {e}")
-                    
-    # Initialize an empty DataFrame with specified columns
-    sunat_info_columns = list(data_keys) + ['nested_' + col for col in nested_data_keys]
-    df = pd.DataFrame(columns=['Id'] + sunat_info_columns)  # Add 'Id' column here
-    
-    # Iterate over rows of sunatinfo_df DataFrame
-    for index, row in sunatinfo_df.iterrows():
-        sunat_info = row['SunatInfo']
-        new_row_data = {'Id': row.Id}  # Add 'Id' to new_row_data
-        for key in data_keys:
-            if isinstance(sunat_info, dict) and key in sunat_info:
-                new_row_data[key] = sunat_info[key]
-            else:
-                new_row_data[key] = np.nan
-        
-        for key in nested_data_keys:
-            nested_key = 'nested_' + key
-            if isinstance(sunat_info, dict) and 'extractedData' in sunat_info:
-                try:
-                    extracted_data = json.loads(sunat_info['extractedData'])
-                    if isinstance(extracted_data, dict) and key in extracted_data:
-                        new_row_data[nested_key] = extracted_data[key]
-                    elif isinstance(extracted_data, dict) and 'data' in extracted_data:
-                        if extracted_data['data'] is not None:
-                            new_row_data[nested_key] = extracted_data['data'].get(key)
-                    else:
-                        extracted_data = sunat_info['extractedData']
-                        extracted_data = json.loads(extracted_data)
-                        extracted_data = json.loads(extracted_data)
-                        new_row_data[nested_key] = extracted_data['data'].get(key)
-                except Exception as e:
-                    new_row_data[nested_key] = np.nan
-            else:
-                new_row_data[nested_key] = np.nan
-            
-        # Assign the row data directly to the DataFrame
-        df.loc[len(df)] = new_row_data
-    
-    df.fillna(np.nan, inplace=True)
-    
-    # Drop rows where all values are None type
-    df.dropna(subset=df.columns, how='all', inplace=True)
-    
-    # df = df[target_columns]
-    df.dropna(subset=df.columns.difference(['Id']), how='all', inplace=True)
-
-    # Add suffix to column names that have nested as prefix
-    new_columns = {col: col + '_nested' if col.startswith('nested_') else col for col in df.columns}
-    df.rename(columns=new_columns, inplace=True) 
-    
-    # Remove prefix from column names
-    new_columns = {col: col.replace('nested_', '') for col in df.columns}
-    df.rename(columns=new_columns, inplace=True)
-
-    connection_string = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+17+for+SQL+Server"
-    engine = create_engine(connection_string)
+# Function to build the sunatinfo DataFrame from the Id and SunatInfo columns of the expenses
+def build_sunatinfo_df(sunatinfo_df):
+    columns = run_transform(parse_sunatinfo_records, zip(sunatinfo_df['Id'], sunatinfo_df['SunatInfo']))
+    df = pd.DataFrame(columns)
 
-    # Apply transformation to each element in the DataFrame
-    df = df.map(transform_to_string)
+    # Serialize the nested columns as JSON
+    df = serialize_nested_columns(df)
     df.drop_duplicates(inplace=True)
 
     target_columns = sunatinfo_target_columns
     df = df.reindex(columns=target_columns, fill_value=np.nan)
+    return df
 
-    df = df[target_columns]
-    df['fecha_carga'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    df.to_sql(target_table, engine, schema=schema_name, if_exists='append', index=False)
-
-def fetch_and_store_extrafields_data(extrafields_df, target_table, status="1"):
-    # Create an empty dictionary to store the extracted values
-    extracted_values = {'Id': []}
-    
+# Function to build the extrafields DataFrame from the Id and ExtraFields columns of expenses or reports
+def build_extrafields_df(extrafields_df, target_table):
     # Extract values for each desired field
     if target_table == 'rindegastos_gastos_extrafields':
         desired_fields = ['Impuesto', 'Centro Costo', 'Tipo Documento', 'RUC Proveedor', 'Serie', 'Correlativo', 'Comentario']
     elif target_table == 'rindegastos_informes_extrafields':
         desired_fields = ['Sede', 'Sociedad', 'Condición Pago', 'Tipo Rendición', 'Tipo Tasa', 'Vacio']
-    for row in extrafields_df.itertuples(index=False):
-        row_values = {field['Name']: field['Value'] for field in row.ExtraFields if field['Name'] in desired_fields}
-        extracted_values['Id'].append(row.Id)
-        for field in desired_fields:
-            cleaned_field = remove_accents_and_spaces(field)
-            if field in row_values:
-                extracted_values[f"{cleaned_field}_Value"] = extracted_values.get(f"{cleaned_field}_Value", []) + [row_values[field]]
-                extracted_values[f"{cleaned_field}_Code"] = extracted_values.get(f"{cleaned_field}_Code", []) + [next((f['Code'] for f in row.ExtraFields if f['Name'] == field), None)]
-            else:
-                extracted_values[f"{cleaned_field}_Value"] = extracted_values.get(f"{cleaned_field}_Value", []) + [None]
-                extracted_values[f"{cleaned_field}_Code"] = extracted_values.get(f"{cleaned_field}_Code", []) + [None]
-    # Replace empty strings with np.nan
-    extracted_values = {k: [np.nan if v == '' else v for v in extracted_values[k]] for k in extracted_values}
-
-    df = pd.DataFrame(extracted_values)
+    columns = run_transform(parse_extrafields_records, zip(extrafields_df['Id'], extrafields_df['ExtraFields']), desired_fields)
 
-    connection_string = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+17+for+SQL+Server"
-    engine = create_engine(connection_string)
+    df = pd.DataFrame(columns)
+    df = apply_schema(df, get_schema(target_table, df.columns))
 
-    # Apply transformation to each element in the DataFrame
-    df = df.map(transform_to_string)
+    # Serialize the nested columns as JSON
+    df = serialize_nested_columns(df)
     df.drop_duplicates(inplace=True)
-    df['fecha_carga'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return df
+
+# Function to build the DataFrames of a batch: the main table and the extrafields/sunatinfo tables related to it.
+# df holds the parsed records and stored_df their serialized version for the main table.
+def build_batch_frames(df, stored_df, target_table):
+    frames = {}
+    if target_table == 'rindegastos_gastos': 
+        # Extract Id and ExtraFields for separate processing and storage
+        frames['rindegastos_gastos_extrafields'] = build_extrafields_df(df[['Id', 'ExtraFields']], 'rindegastos_gastos_extrafields')
+        # Extract Id and SunatInfo for separate processing and storage
+        sunatinfo_df = build_sunatinfo_df(df[['Id', 'SunatInfo']])
+        if SUNAT_SUPPLIER_DIMENSION:
+            # The taxpayer profile is stored once per RUC and only when its lastUpdate changed
+            sunatinfo_df, suppliers_df = split_sunatinfo_df(sunatinfo_df)
+            frames[SUPPLIER_TABLE] = filter_changed_suppliers(suppliers_df)
+        frames['rindegastos_gastos_sunatinfo'] = sunatinfo_df
+    elif target_table == 'rindegastos_informes': 
+        # Extract Id and ExtraFields for separate processing and storage
+        frames['rindegastos_informes_extrafields'] = build_extrafields_df(df[['Id', 'ExtraFields']], 'rindegastos_informes_extrafields')
+    frames[target_table] = stored_df.copy(deep=False)
+
+    fecha_carga = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for frame in frames.values():
+        frame['fecha_carga'] = fecha_carga
+    return frames
 
-    df.to_sql(target_table, engine, schema=schema_name, if_exists='append', index=False)
-
-MAX_RETRIES = 3
-RETRY_DELAY = 5  # in seconds
 LOG_FILE = "logs.txt"  # Log file name
 
 if not os.path.exists(LOG_FILE):
     with open(LOG_FILE, 'w') as f:
         pass
         
-# Function to fetch data and store it in a DataFrame
-def fetch_and_store_data(endpoint, target_table, data_key, status="1"):
-    retries = 0
-    while retries < MAX_RETRIES:
+class PageFetchException(Exception):
+    pass
+
+# Errors raised while a streamed response body is read, after request_with_retry has already returned it
+BODY_READ_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# Function to fetch and decode a single page of results. Timeouts, connection errors, 429 and 5xx responses are
+# retried inside request_with_retry; the body is streamed afterwards, so the errors raised while reading it are
+# retried here with the same policy and counted by the circuit breaker. Any other failure raises. Completed pages
+# are saved to the checkpoint, and only the number of pages is returned so the records are not kept in memory
+# until every page has been fetched.
+def fetch_page(endpoint, params, page, data_key, status, checkpoint, pages=None):
+    for attempt in range(RINDEGASTOS_POLICY.max_retries):
+        result = endpoint(dict(params, Page=str(page)))
         try:
-            all_data = []
-            page = 1
-            params = {}
-            
-            if target_table == "rindegastos_informes":
-                if status == "1":
-                    params["Since"] = f"{reference_date}"
-                else:
-                    params["Status"] = status
-            elif target_table == "rindegastos_gastos":
-                params["Since"] = f"{reference_date}"
-                params["Until"] = f"{today}"
+            if result.status_code != 200:
+                raise PageFetchException(f"HTTP Error {result.status_code}: Unable to fetch page {page} of {data_key} with status {status}")
+            try:
+                # The records are decoded while the response is downloaded; the other keys stay in the skeleton
+                streamed_page = StreamedPage(result.iter_content(chunk_size=STREAM_CHUNK_SIZE), data_key)
+                records = list(streamed_page)
+                break
+            except DecodeError as e:
+                raise PageFetchException(f"Failed to decode JSON response for page {page} of {data_key} with status {status}: {e}")
+            except BODY_READ_ERRORS as e:
+                RINDEGASTOS_BREAKER.record_failure()
+                if attempt + 1 == RINDEGASTOS_POLICY.max_retries:
+                    raise PageFetchException(f"Failed to read page {page} of {data_key} with status {status}: {e}")
+                delay = RINDEGASTOS_POLICY.get_delay(attempt)
+                print(f"Error reading page {page} of {data_key} with status {status} ({e}). Retrying in {delay:.1f} seconds...")
+        finally:
+            result.close()
+        time.sleep(delay)
+
+    totals = streamed_page.skeleton.get('Records', {})
+    if pages is None:
+        pages = totals.get('Pages', 1)
+    checkpoint.save_page(page, records, pages, totals.get('Total'))
+    print(f"Processed page {page} out of {pages} for {data_key} with status {status}.")
+    return pages
+
+# Function to transform and store a batch of records of an entity. Returns the number of records in the batch.
+def store_batch(records, target_table, data_key, status):
+    with stage('transform'):
+        df = build_frame(records)
+
+        # Convert to the compact dtypes of the entity
+        typed_df = apply_schema(df, get_schema(target_table))
+
+    if MEMORY_REPORT:
+        memory_report(df, typed_df, f"{data_key} with status {status}")
+    df = typed_df
+
+    # Keep the ReportNumber -> Id index used by the report refresh up to date
+    if target_table == 'rindegastos_informes' and 'ReportNumber' in df.columns:
+        report_numbers = df[['ReportNumber', 'Id']].dropna()
+        update_report_index(zip(report_numbers['ReportNumber'], report_numbers['Id']))
+
+    if df.empty:
+        return 0
+    stored_records = len(df)
+
+    # Keep only the records within the reference window for statuses other than approved
+    if status != "1":
+        if target_table == "rindegastos_gastos":
+            if 'IssueDate' in df.columns:
+                df = df[df['IssueDate'].str[:4].astype(int) >= int(reference_date[:4])]
+        else:
+            if 'SendDate' in df.columns:
+                df = df[df['SendDate'].str[:4].astype(int) >= int(reference_date[:4])]
+
+    with stage('transform'):
+        # Serialize the nested columns as JSON
+        stored_df = serialize_nested_columns(df)
+        stored_df = stored_df.drop_duplicates()
+
+    if INCREMENTAL_LOAD:
+        # Write only the records that are new or changed since the last load
+        with stage('load'):
+            stored_df, changed_ids = filter_changed_records(stored_df, target_table, compute_record_hashes(records))
+            df = df[df['Id'].isin(stored_df['Id'])]
+
+    with stage('transform'):
+        frames = build_batch_frames(df, stored_df.drop(columns=[HASH_COLUMN], errors='ignore'), target_table)
+        if INCREMENTAL_LOAD:
+            # The Ids written by the run are committed together with the batch
+            frames[CHANGE_TABLE] = build_batch_changes(target_table, stored_df['Id'], changed_ids)
+
+    # The previous version of the changed records is deleted in the transaction of each table
+    delete_ids = {table: changed_ids for table in RELATED_TABLES.get(target_table, []) + [target_table]} if INCREMENTAL_LOAD else None
+
+    with stage('load'):
+        # The main table and its related tables are written concurrently and committed once all of them are written
+        write_tables_concurrently(frames, upsert_keys=SUPPLIER_UPSERT_KEYS, delete_ids=delete_ids)
+        if INCREMENTAL_LOAD:
+            store_hashes(stored_df, target_table)
+        if target_table == 'rindegastos_gastos':
+            # Keep the local copy of the expense detail in sync with what was just written
+            sync_expense_details(df, frames.get('rindegastos_gastos_extrafields'))
+    return stored_records
+
+# Function to fetch data and store it in a DataFrame
+# For expenses and reports, since and until restrict the fetch to a slice of the window (both dates included).
+# checkpoint_namespace keeps the checkpoints of other commands apart from those of the daily run.
+def fetch_and_store_data(endpoint, target_table, data_key, status="1", since=None, until=None, checkpoint_namespace=None):
+    try:
+        params = {}
+        
+        if target_table == "rindegastos_informes":
+            if status == "1":
+                params["Since"] = f"{since or reference_date}"
+                if until:
+                    params["Until"] = f"{until}"
+            else:
                 params["Status"] = status
-                params["IntegrationStatus"] = 0
-                
-            params["ResultsPerPage"] = "1000"
+        elif target_table == "rindegastos_gastos":
+            params["Since"] = f"{since or reference_date}"
+            params["Until"] = f"{until or today}"
+            params["Status"] = status
+            params["IntegrationStatus"] = 0
             
-            while True:
-                params["Page"] = str(page)
-                result = endpoint(params)
-                
-                if result.status_code != 200:
-                    print(f"HTTP Error {result.status_code}: Unable to fetch page {page}")
-                    break
-                
-                response_data = result.text
-                try:
-                    data = json.loads(response_data)
-                except json.JSONDecodeError:
-                    print(f"Failed to decode JSON response for page {page}")
-                    break
-                
-                records = data.get(data_key, [])
-                all_data.extend(records)
-                
-                pages = data.get('Records', {}).get('Pages', 1)
-                print(f"Processed page {page} out of {pages} for {data_key} with status {status}.")
-                
-                page += 1
-                if page > pages:
-                    break
-            
-            df = pd.DataFrame(all_data)
+        params["ResultsPerPage"] = "1000"
         
-            if target_table == 'rindegastos_gastos': 
-                # Extract Id and ExtraFields for separate processing and storage
-                extrafields_df = df[['Id', 'ExtraFields']]
-                # Extract Id and SunatInfo for separate processing and storage
-                sunatinfo_df = df[['Id', 'SunatInfo']]
-                
-                if status == "1":
-                    fetch_and_store_extrafields_data(extrafields_df, 'rindegastos_gastos_extrafields')
-                    fetch_and_store_sunatinfo_data(sunatinfo_df, 'rindegastos_gastos_sunatinfo')
-                else:
-                    fetch_and_store_extrafields_data(extrafields_df, 'rindegastos_gastos_extrafields', "0")
-                    fetch_and_store_sunatinfo_data(sunatinfo_df, 'rindegastos_gastos_sunatinfo', "0")
-                    
-            elif target_table == 'rindegastos_informes': 
-                # Extract Id and ExtraFields for separate processing and storage
-                extrafields_df = df[['Id', 'ExtraFields']]
-                if status == "1":
-                    fetch_and_store_extrafields_data(extrafields_df, 'rindegastos_informes_extrafields')
-                else:
-                    fetch_and_store_extrafields_data(extrafields_df, 'rindegastos_informes_extrafields', '0')
+        # Resume from the pages already downloaded by an interrupted run
+        checkpoint = PageCheckpoint(target_table, data_key, params, checkpoint_namespace)
+        completed_pages = checkpoint.completed_pages
+        if completed_pages:
+            print(f"Resuming {data_key} with status {status} from checkpoint: {len(completed_pages)} of {checkpoint.pages} pages already fetched.")
         
-            connection_string = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+17+for+SQL+Server"
-            engine = create_engine(connection_string)
+        with stage('fetch'):
+            # The first page tells how many pages there are, the rest are fetched concurrently.
+            # It is fetched again when resuming: if the results changed since the checkpoint was saved, records may
+            # have shifted across pages and the checkpoint is discarded, so no record is missed (and later deleted).
+            saved_totals = (checkpoint.pages, checkpoint.total)
+            pages = fetch_page(endpoint, params, 1, data_key, status, checkpoint)
+            if completed_pages and (pages, checkpoint.total) != saved_totals:
+                print(f"Results of {data_key} with status {status} changed since the checkpoint was saved, fetching every page again.")
+                checkpoint.clear()
+                checkpoint = PageCheckpoint(target_table, data_key, params, checkpoint_namespace)
+                completed_pages = set()
+                pages = fetch_page(endpoint, params, 1, data_key, status, checkpoint)
+
+            missing_pages = [page for page in range(2, pages + 1) if page not in completed_pages]
+            if missing_pages:
+                run_concurrently(
+                    lambda page: fetch_page(endpoint, params, page, data_key, status, checkpoint, pages),
+                    missing_pages,
+                    RINDEGASTOS_LIMITER,
+                )
         
-            # Apply transformation to each element in the DataFrame
-            df = df.map(transform_to_string)
-            df.drop_duplicates(inplace=True)
-            df['fecha_carga'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
+        # Reference entities rarely change: skip the write when the payload is the same as last time
+        fingerprint = None
+        if target_table in REFERENCE_TABLES:
+            all_data = [record for page in range(1, pages + 1) for record in checkpoint.load_page(page)]
+            fingerprint = compute_payload_fingerprint(all_data)
+            stored_fingerprint, age_hours = get_fingerprint(target_table)
+            if fingerprint == stored_fingerprint and age_hours < REFERENCE_TABLES_TTL_HOURS:
+                register_seen_ids(target_table, [record['Id'] for record in all_data])
+                print(f"{data_key} unchanged since the last load ({age_hours:.1f} hours ago), skipping the write.")
+                checkpoint.clear()
+                with open(LOG_FILE, 'a') as f:
+                    f.write(f"{datetime.datetime.now()} - Skipped {data_key}: unchanged since the last load\n")
+                return True
+            del all_data
         
-            if status == "1":
-                df.to_sql(target_table, engine, schema=schema_name, if_exists='append', index=False)
-            else:
-                if target_table == "rindegastos_gastos":
-                    if 'IssueDate' in df.columns:
-                        df = df[df['IssueDate'].str[:4].astype(int) >= int(reference_date[:4])]
-                else:
-                    if 'SendDate' in df.columns:
-                        df = df[df['SendDate'].str[:4].astype(int) >= int(reference_date[:4])]
-                df.to_sql(target_table, engine, schema=schema_name, if_exists='append', index=False)
-                
-            # Log success
+        # The pages are read back from the checkpoint in batches that fit in the memory budget
+        budget = MemoryBudget()
+        stored_records = 0
+        for batch in iter_record_batches(checkpoint, pages, budget, lambda records: to_compact_records(records, data_key)):
+            stored_records += store_batch(batch, target_table, data_key, status)
+
+        if stored_records == 0:
+            print(f"No records found for {data_key} with status {status}.")
             with open(LOG_FILE, 'a') as f:
-                f.write(f"{datetime.datetime.now()} - Successfully fetched and stored {data_key} with status {status} after {retries} retries\n")
+                f.write(f"{datetime.datetime.now()} - No records found for {data_key} with status {status}\n")
+            checkpoint.clear()
+            return True
+        if MEMORY_REPORT:
+            report_peak_rss(f"{data_key} with status {status}")
             
-            break  # Exit retry loop on success
-        except (requests.exceptions.RequestException, timeout) as e:
-            retries += 1
-            time.sleep(RETRY_DELAY)
-        except Exception as e:
-            with open(LOG_FILE, 'a') as f:
-                f.write(f"{datetime.datetime.now()} - Error: {e}\n")
-            retries += 1
-                
-    if retries == MAX_RETRIES:
+        if fingerprint is not None:
+            set_fingerprint(target_table, fingerprint)
+        checkpoint.clear()
+        
+        # Log success
+        with open(LOG_FILE, 'a') as f:
+            f.write(f"{datetime.datetime.now()} - Successfully fetched and stored {data_key} with status {status}\n")
+        
+        return True
+    except Exception as e:
+        # Requests are already retried inside request_with_retry; the pages fetched so far stay in the checkpoint
+        print(f"Failed to fetch and store {data_key} with status {status}: {e}")
         with open(LOG_FILE, 'a') as f:
-            f.write(f"{datetime.datetime.now()} - Error: Failed to fetch and store {data_key} with status {status} after {retries} retries\n")
+            f.write(f"{datetime.datetime.now()} - Error: Failed to fetch and store {data_key} with status {status}: {e}\n")
+        return False
             
 # Function to delete records from various tables
-def delete_rindegastos_gastos():
+# With status only the records in that status are deleted, for loads that only reload one status (such as the backfill)
+def delete_rindegastos_gastos(since=None, until=None, status=None):
     print('Deleting gastos')
     conn = get_database_connection()
     cursor = conn.cursor()
 
     try:
-        cursor.execute(f"SELECT Id FROM ciclo_proveedores.fil.rindegastos_gastos WHERE IssueDate >= '{reference_date}'")
+        since = since or reference_date
+        query = f"SELECT Id FROM ciclo_proveedores.fil.rindegastos_gastos WHERE IssueDate >= '{since}'"
+        if until:
+            query += f" AND IssueDate < '{next_day(until)}'"
+        if status is not None:
+            query += f" AND Status = {int(status)}"
+        cursor.execute(query)
         ids = [row.Id for row in cursor.fetchall()]
 
         if ids:
@@ -342,9 +358,10 @@ def delete_rindegastos_gastos():
             cursor.execute(f"DELETE FROM ciclo_proveedores.fil.rindegastos_gastos WHERE Id IN ({','.join(map(str, ids))})")
             print("Deleted rindegastos_gastos records")
         else:
-            print(f"No records found in rindegastos_gastos where IssueDate >= {reference_date}")
+            print(f"No records found in rindegastos_gastos where IssueDate >= {since}" + (f" and IssueDate <= {until}" if until else ""))
 
         conn.commit()
+        remove_expense_details(ids)
 
     except Exception as e:
         print(f"Error deleting records: {e}")
@@ -353,13 +370,19 @@ def delete_rindegastos_gastos():
         cursor.close()
         conn.close()
         
-def delete_rindegastos_informes():    
+def delete_rindegastos_informes(since=None, until=None, status=None):    
     print('Deleting informes')
     conn = get_database_connection()
     cursor = conn.cursor()
 
     try:
-        cursor.execute(f"SELECT Id FROM ciclo_proveedores.fil.rindegastos_informes WHERE SendDate >= '{reference_date}'")
+        since = since or reference_date
+        query = f"SELECT Id FROM ciclo_proveedores.fil.rindegastos_informes WHERE SendDate >= '{since}'"
+        if until:
+            query += f" AND SendDate < '{next_day(until)}'"
+        if status is not None:
+            query += f" AND Status = {int(status)}"
+        cursor.execute(query)
         ids = [row.Id for row in cursor.fetchall()]
 
         if ids:
@@ -367,7 +390,7 @@ def delete_rindegastos_informes():
             cursor.execute(f"DELETE FROM ciclo_proveedores.fil.rindegastos_informes WHERE Id IN ({','.join(map(str, ids))})")
             print("Deleted rindegastos_informes records")
         else:
-            print(f"No records found in rindegastos_informes where SendDate >= {reference_date}")
+            print(f"No records found in rindegastos_informes where SendDate >= {since}" + (f" and SendDate <= {until}" if until else ""))
 
         conn.commit()
 
@@ -378,6 +401,21 @@ def delete_rindegastos_informes():
         cursor.close()
         conn.close()
 
+# Function to delete (or only report) the records that were not returned by the API in the current run
+def handle_missing_records(target_table, missing_ids):
+    if not missing_ids:
+        print(f"No missing records in {target_table}")
+        return
+    print(f"{len(missing_ids)} records of {target_table} were not returned by the API")
+    with open(LOG_FILE, 'a') as f:
+        f.write(f"{datetime.datetime.now()} - {len(missing_ids)} records of {target_table} were not returned by the API: {sorted(missing_ids)}\n")
+    if DELETE_MISSING_RECORDS:
+        delete_records(target_table, missing_ids, include_hashes=True)
+        record_changes(target_table, missing_ids, 'D')
+        if target_table == 'rindegastos_gastos':
+            remove_expense_details(missing_ids)
+        print(f"Deleted {len(missing_ids)} missing records from {target_table}")
+
 def drop_any_duplacates():
     # Drop any duplicates 
     conn = get_database_connection()
@@ -392,13 +430,17 @@ def drop_any_duplacates():
         'fil.rindegastos_politicas',
         'fil.rindegastos_usuarios'
     ]
+    # A supplier loaded by two partitions at the same time can be inserted twice
+    if SUNAT_SUPPLIER_DIMENSION:
+        tables.append(f'fil.{SUPPLIER_TABLE}')
 
     try:
         for table in tables:
+            key = SUPPLIER_KEY if table == f'fil.{SUPPLIER_TABLE}' else 'Id'
             cursor.execute(f'''
                 WITH CTE AS (
                     SELECT *,
-                        ROW_NUMBER() OVER (PARTITION BY Id ORDER BY fecha_carga DESC) AS RowNumber
+                        ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY fecha_carga DESC) AS RowNumber
                     FROM {table}
                 )
                 DELETE FROM CTE
@@ -420,29 +462,32 @@ def drop_any_duplacates():
 def get_expenses(params, token):
     url = "https://api.rindegastos.com/v1/getExpenses"
     headers = {"Authorization": f"Bearer {token}"}
-    return requests.get(url, params=params, headers=headers)
+    return request_with_retry('GET', url, RINDEGASTOS_POLICY, RINDEGASTOS_BREAKER, RINDEGASTOS_LIMITER, params=params, headers=headers, stream=True)
 
 def get_users(params, token):
     url = "https://api.rindegastos.com/v1/getUsers"
     headers = {"Authorization": f"Bearer {token}"}
-    return requests.get(url, params=params, headers=headers)
+    return request_with_retry('GET', url, RINDEGASTOS_POLICY, RINDEGASTOS_BREAKER, RINDEGASTOS_LIMITER, params=params, headers=headers)
 
 def get_expense_reports(params, token):
     url = "https://api.rindegastos.com/v1/getExpenseReports"
     headers = {"Authorization": f"Bearer {token}"}
-    return requests.get(url, params=params, headers=headers)
+    return request_with_retry('GET', url, RINDEGASTOS_POLICY, RINDEGASTOS_BREAKER, RINDEGASTOS_LIMITER, params=params, headers=headers, stream=True)
 
 def get_expense_policies(params, token):
     url = "https://api.rindegastos.com/v1/getExpensePolicies"
     headers = {"Authorization": f"Bearer {token}"}
-    return requests.get(url, params=params, headers=headers)
+    return request_with_retry('GET', url, RINDEGASTOS_POLICY, RINDEGASTOS_BREAKER, RINDEGASTOS_LIMITER, params=params, headers=headers)
 
 @log_exceptions
+# Returns True when every partition was loaded, so the run lease records whether the run succeeded
+# (log_exceptions returns None when it fails)
 def main():
     if not check_api_availability():
-        return
+        return False
     start_time = time.time()            
     token = os.getenv('API_TOKEN')
+    remove_stale_checkpoints()
 
     # Create endpoint lambdas that include the token in the API calls
     get_expenses_endpoint = lambda params: get_expenses(params, token)
@@ -450,46 +495,75 @@ def main():
     get_expense_reports_endpoint = lambda params: get_expense_reports(params, token)
     get_expense_policies_endpoint = lambda params: get_expense_policies(params, token)
     
-    # Delete existing records first
-    delete_rindegastos_gastos()
-    delete_rindegastos_informes()
+    # Plan the date slices x status partitions refreshed today
+    expense_partitions, expense_slices = plan_partitions(['1', '0', '2'], reference_date, today)
+    report_partitions, report_slices = plan_partitions(['1'], reference_date, today)
+    print(f"Refreshing {len(expense_slices)} slices of expenses and {len(report_slices)} slices of reports")
+    
+    if not INCREMENTAL_LOAD:
+        # Delete existing records of the refreshed slices first
+        for since, until in expense_slices:
+            delete_rindegastos_gastos(since, until)
+        for since, until in report_slices:
+            delete_rindegastos_informes(since, until)
+    else:
+        # The hash and change-log tables are created before the partitions write concurrently
+        ensure_tracking_tables()
     
     # Fetch and store operations for updating data
     # Fetch and store expenses
-    fetch_and_store_data(get_expenses_endpoint, 'rindegastos_gastos', 'Expenses', '1')
-    fetch_and_store_data(get_expenses_endpoint, 'rindegastos_gastos', 'Expenses', '0')
-    fetch_and_store_data(get_expenses_endpoint, 'rindegastos_gastos', 'Expenses', '2')
+    expense_results = run_partitions(
+        lambda partition: fetch_and_store_data(get_expenses_endpoint, 'rindegastos_gastos', 'Expenses', partition.status, partition.since, partition.until),
+        expense_partitions,
+    )
     
     # Fetch and store users
     fetch_and_store_data(get_users_endpoint, 'rindegastos_usuarios', 'Users')
     
     # Fetch and store expense reports
-    fetch_and_store_data(get_expense_reports_endpoint, 'rindegastos_informes', 'ExpenseReports', '1')
-    fetch_and_store_data(get_expense_reports_endpoint, 'rindegastos_informes', 'ExpenseReports', '0')
+    report_results = run_partitions(
+        lambda partition: fetch_and_store_data(get_expense_reports_endpoint, 'rindegastos_informes', 'ExpenseReports', partition.status, partition.since, partition.until),
+        report_partitions,
+    )
+    reports_in_process_loaded = fetch_and_store_data(get_expense_reports_endpoint, 'rindegastos_informes', 'ExpenseReports', '0')
     
     # Fetch and store expense policies
     fetch_and_store_data(get_expense_policies_endpoint, 'rindegastos_politicas', 'Policies')
+
+    if INCREMENTAL_LOAD:
+        # Remove the records that no longer exist in Rindegastos, only within the slices that loaded completely
+        for since, until in successful_slices(expense_slices, expense_results):
+            handle_missing_records('rindegastos_gastos', find_missing_ids('rindegastos_gastos', 'IssueDate', since, until))
+        if reports_in_process_loaded:
+            for since, until in successful_slices(report_slices, report_results):
+                handle_missing_records('rindegastos_informes', find_missing_ids('rindegastos_informes', 'SendDate', since, until))
+        for table in ['rindegastos_usuarios', 'rindegastos_politicas']:
+            missing_ids = find_missing_hashed_ids(table)
+            if missing_ids:
+                print(f"{len(missing_ids)} records of {table} were not returned by the API: {sorted(missing_ids)}")
     
     # Drop any duplicates 
     drop_any_duplacates()
+    prune_detail_cache()
     
-    # Add EXEC statement at the end
-    print("Executing stored procedure fil.sp_actualiza_reporte_rindegastos...")
-    try:
-        conn = get_database_connection()
-        cursor = conn.cursor()
-        cursor.execute(f"EXEC fil.sp_actualiza_reporte_rindegastos")  # Replace with your actual stored procedure
-        conn.commit()
-    except Exception as e:
-        print(f"Error executing stored procedure: {e}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    # Refresh the reporting tables; only the incremental load records the Ids changed by the run
+    execute_report_refresh(mode=REPORT_REFRESH_MODE if INCREMENTAL_LOAD else 'full')
     
     end_time = time.time()
     execution_time = end_time - start_time
     print(f"Execution time: {execution_time} seconds")
+    report_peak_rss('cargar_rindegastos')
+    return all(expense_results.values()) and all(report_results.values()) and reports_in_process_loaded
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Carga los gastos, informes, usuarios y políticas de Rindegastos")
+    parser.add_argument('--profile', action='store_true', help="Guarda perfiles de CPU y memoria por etapa en PROFILE_DIR")
+    args = parser.parse_args()
+
+    if args.profile:
+        enable_profiling('cargar_rindegastos')
+    try:
+        # A run started while another one is in progress (scheduled task and Titán) does not repeat its work
+        run_with_lease('cargar_rindegastos', main, get_database_connection)
+    finally:
+        write_profile_report()
@@ -0,0 +1,194 @@
+import json
+import math
+import hashlib
+import datetime
+import threading
+from db_utils import get_database_connection, get_engine, chunk_ids, schema_name
+from partition_planner import next_day
+from json_codec import dumps_bytes
+from change_log import CHANGE_TABLE
+
+# Table where the content hash of every loaded record is stored, keyed by table and Id
+HASH_TABLE = 'rindegastos_hashes'
+HASH_COLUMN = 'hash_contenido'
+
+# Tables whose rows share the Id of a record in the main table
+RELATED_TABLES = {
+    'rindegastos_gastos': ['rindegastos_gastos_extrafields', 'rindegastos_gastos_sunatinfo'],
+    'rindegastos_informes': ['rindegastos_informes_extrafields'],
+}
+
+# Ids received from the API during the current run, per table
+_seen_ids = {}
+_seen_ids_lock = threading.Lock()
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+# Function to create the hash and change-log tables if they do not exist yet. It runs before the partitions start,
+# so the first incremental load does not create them from the open transactions of concurrent batches.
+def ensure_tracking_tables():
+    conn = get_database_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'''
+            IF OBJECT_ID('{schema_name}.{HASH_TABLE}', 'U') IS NULL
+            BEGIN
+                CREATE TABLE {schema_name}.{HASH_TABLE} (
+                    tabla VARCHAR(100) NOT NULL,
+                    Id BIGINT NOT NULL,
+                    {HASH_COLUMN} VARCHAR(16) NULL,
+                    fecha_carga VARCHAR(19) NULL
+                );
+                CREATE INDEX IX_{HASH_TABLE}_tabla_Id ON {schema_name}.{HASH_TABLE} (tabla, Id);
+            END''')
+        cursor.execute(f'''
+            IF OBJECT_ID('{schema_name}.{CHANGE_TABLE}', 'U') IS NULL
+                CREATE TABLE {schema_name}.{CHANGE_TABLE} (
+                    run_id VARCHAR(32) NOT NULL,
+                    tabla VARCHAR(100) NOT NULL,
+                    Id BIGINT NOT NULL,
+                    operacion CHAR(1) NOT NULL,
+                    fecha VARCHAR(19) NULL
+                )''')
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+# Function to compute the content hash of each record from its canonical JSON (sorted keys, without null fields),
+# so the hash of a record does not depend on the other records of its batch. Returns a dictionary {Id: hash}.
+def compute_record_hashes(records):
+    hashes = {}
+    for record in records:
+        data = record.to_dict() if hasattr(record, 'to_dict') else record
+        canonical = dumps_bytes({key: value for key, value in data.items() if not is_null(value)}, sort_keys=True)
+        hashes[data['Id']] = hashlib.blake2b(canonical, digest_size=8).hexdigest()
+    return hashes
+
+# Function to load the stored hashes of a table as a dictionary {Id: hash}, only for the given Ids if any
+def load_stored_hashes(target_table, ids=None):
+    try:
+        conn = get_database_connection()
+        cursor = conn.cursor()
+        query = f"SELECT Id, {HASH_COLUMN} FROM {schema_name}.{HASH_TABLE} WHERE tabla = ?"
+        stored_hashes = {}
+        if ids is None:
+            cursor.execute(query, target_table)
+            stored_hashes.update((row[0], row[1]) for row in cursor.fetchall())
+        else:
+            for chunk in chunk_ids(ids):
+                cursor.execute(f"{query} AND Id IN ({','.join(map(str, chunk))})", target_table)
+                stored_hashes.update((row[0], row[1]) for row in cursor.fetchall())
+        cursor.close()
+        conn.close()
+        return stored_hashes
+    except Exception as e:
+        # The hash table does not exist until the first incremental load
+        print(f"Could not load stored hashes for {target_table}: {e}")
+        return {}
+
+# Function to keep only the rows that are new or changed since the last load, given the hashes of the source
+# records from compute_record_hashes. Returns the filtered DataFrame (with its hash column) and the Ids of the changed rows.
+def filter_changed_records(df, target_table, record_hashes):
+    df = df.copy(deep=False)
+    df[HASH_COLUMN] = df['Id'].map(record_hashes)
+    register_seen_ids(target_table, df['Id'])
+
+    stored_hashes = load_stored_hashes(target_table, df['Id'].unique().tolist())
+    stored = df['Id'].map(stored_hashes)
+    inserted = stored.isna()
+    changed = ~inserted & (stored != df[HASH_COLUMN])
+
+    print(f"{target_table}: {int(inserted.sum())} new, {int(changed.sum())} changed, {int((~inserted & ~changed).sum())} unchanged records.")
+    changed_ids = df.loc[changed, 'Id'].unique().tolist()
+    return df[inserted | changed], changed_ids
+
+# Function to register the Ids received from the API for a table
+def register_seen_ids(target_table, ids):
+    with _seen_ids_lock:
+        _seen_ids.setdefault(target_table, set()).update(ids)
+
+# Function to get the Ids received from the API for a table during the current run
+def get_seen_ids(target_table):
+    with _seen_ids_lock:
+        return set(_seen_ids.get(target_table, set()))
+
+# Function to forget the Ids received so far, for processes that load several times (such as the listener)
+def clear_seen_ids():
+    with _seen_ids_lock:
+        _seen_ids.clear()
+
+# Function to delete records by Id from a table and the tables related to it
+def delete_records(target_table, ids, include_hashes=False):
+    ids = list(ids)
+    if not ids:
+        return
+    tables = RELATED_TABLES.get(target_table, []) + [target_table]
+    conn = get_database_connection()
+    cursor = conn.cursor()
+    try:
+        for chunk in chunk_ids(ids):
+            id_list = ','.join(map(str, chunk))
+            for table in tables:
+                cursor.execute(f"DELETE FROM {schema_name}.{table} WHERE Id IN ({id_list})")
+            if include_hashes:
+                cursor.execute(f"DELETE FROM {schema_name}.{HASH_TABLE} WHERE tabla = ? AND Id IN ({id_list})", target_table)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+# Function to store the hashes of the rows that were just written
+def store_hashes(df, target_table):
+    if df.empty:
+        return
+    hashes_df = df[['Id', HASH_COLUMN]].drop_duplicates(subset='Id', keep='last').copy()
+    hashes_df.insert(0, 'tabla', target_table)
+    hashes_df['fecha_carga'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    conn = get_database_connection()
+    cursor = conn.cursor()
+    try:
+        for chunk in chunk_ids(hashes_df['Id'].tolist()):
+            cursor.execute(f"DELETE FROM {schema_name}.{HASH_TABLE} WHERE tabla = ? AND Id IN ({','.join(map(str, chunk))})", target_table)
+        conn.commit()
+    except Exception as e:
+        # The hash table is created by to_sql on the first load
+        print(f"Could not delete previous hashes for {target_table}: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+        conn.close()
+
+    hashes_df.to_sql(HASH_TABLE, get_engine(), schema=schema_name, if_exists='append', index=False)
+
+# Function to find the Ids stored in a table within a date window (both dates included)
+# that were not received in the current run
+def find_missing_ids(target_table, date_column, since, until=None):
+    conn = get_database_connection()
+    cursor = conn.cursor()
+    try:
+        query = f"SELECT Id FROM {schema_name}.{target_table} WHERE {date_column} >= ?"
+        query_params = [since]
+        if until is not None:
+            query += f" AND {date_column} < ?"
+            query_params.append(next_day(until))
+        cursor.execute(query, *query_params)
+        stored_ids = {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+        conn.close()
+    return stored_ids - get_seen_ids(target_table)
+
+# Function to find the Ids with a stored hash that were not received in the current run
+def find_missing_hashed_ids(target_table):
+    return set(load_stored_hashes(target_table)) - get_seen_ids(target_table)
+
+# Function to compute the fingerprint of a whole API payload, independent of the key order of its records
+def compute_payload_fingerprint(records):
+    payload = json.dumps(records, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
@@ -0,0 +1,65 @@
+import uuid
+import datetime
+import pandas as pd
+from db_utils import get_database_connection, get_engine, schema_name
+from profiling import stage
+from params import REPORT_REFRESH_MODE
+
+# Table with the Ids inserted (I), updated (U) or deleted (D) by each run, read by the incremental
+# mode of fil.sp_actualiza_reporte_rindegastos
+CHANGE_TABLE = 'rindegastos_cambios'
+
+# Identifier of the current run, shared by every load of the process until start_new_run is called
+RUN_ID = uuid.uuid4().hex
+
+# Function to start a new run, for processes that refresh the report several times (such as the listener)
+def start_new_run():
+    global RUN_ID
+    RUN_ID = uuid.uuid4().hex
+    return RUN_ID
+
+# Function to build the change-log rows of a set of Ids of a table
+def build_change_frame(target_table, ids, operation, run_id=None):
+    ids = pd.Series(list(ids), dtype='int64').drop_duplicates()
+    return pd.DataFrame({
+        'run_id': run_id or RUN_ID,
+        'tabla': target_table,
+        'Id': ids,
+        'operacion': operation,
+        'fecha': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
+
+# Function to build the change-log rows of a batch: the Ids of changed_ids are updates, the rest inserts
+def build_batch_changes(target_table, ids, changed_ids, run_id=None):
+    changed_ids = set(changed_ids)
+    inserted_ids = [record_id for record_id in pd.unique(pd.Series(ids)) if record_id not in changed_ids]
+    return pd.concat([
+        build_change_frame(target_table, inserted_ids, 'I', run_id),
+        build_change_frame(target_table, changed_ids, 'U', run_id),
+    ], ignore_index=True)
+
+# Function to record Ids changed outside a batch, such as the records deleted because the API no longer returns them
+def record_changes(target_table, ids, operation, run_id=None):
+    changes_df = build_change_frame(target_table, ids, operation, run_id)
+    if not changes_df.empty:
+        changes_df.to_sql(CHANGE_TABLE, get_engine(), schema=schema_name, if_exists='append', index=False)
+
+# Function to run fil.sp_actualiza_reporte_rindegastos. In the 'incremental' REPORT_REFRESH_MODE the run
+# identifier is passed so the procedure only refreshes the Ids recorded by this run; in 'full' mode it rebuilds everything.
+def execute_report_refresh(run_id=None, mode=REPORT_REFRESH_MODE):
+    print(f"Executing stored procedure fil.sp_actualiza_reporte_rindegastos ({mode} mode)...")
+    conn = get_database_connection()
+    cursor = conn.cursor()
+    try:
+        with stage('sp'):
+            if mode == 'incremental':
+                cursor.execute("EXEC fil.sp_actualiza_reporte_rindegastos @run_id = ?", run_id or RUN_ID)
+            else:
+                cursor.execute("EXEC fil.sp_actualiza_reporte_rindegastos")
+            conn.commit()
+    except Exception as e:
+        print(f"Error executing stored procedure: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+        conn.close()
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import datetime
+import threading
+from json_codec import dumps_bytes, load_file
+from params import CHECKPOINT_DIR, CHECKPOINT_MAX_AGE_DAYS
+
+# Function to delete the checkpoints that were never resumed
+def remove_stale_checkpoints(max_age_days=CHECKPOINT_MAX_AGE_DAYS):
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+    limit = time.time() - max_age_days * 24 * 60 * 60
+    for name in os.listdir(CHECKPOINT_DIR):
+        path = os.path.join(CHECKPOINT_DIR, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < limit:
+            shutil.rmtree(path, ignore_errors=True)
+            print(f"Removed stale checkpoint {name}")
+
+# Persisted progress of a paged fetch: the endpoint, its parameters and the pages already downloaded.
+# Each completed page is stored on disk, so an interrupted run resumes from the pages that are missing.
+# namespace separates the checkpoints of different commands that fetch the same pages, such as the daily run and the backfill.
+class PageCheckpoint:
+    def __init__(self, target_table, data_key, params, namespace=None):
+        params = {key: value for key, value in params.items() if key != 'Page'}
+        key = {'target_table': target_table, 'data_key': data_key, 'params': params}
+        if namespace is not None:
+            key['namespace'] = namespace
+        fingerprint = json.dumps(key, sort_keys=True, default=str)
+        self.key = f"{target_table}_{hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:12]}"
+        self.path = os.path.join(CHECKPOINT_DIR, self.key)
+        self.state_file = os.path.join(self.path, 'state.json')
+        self.lock = threading.Lock()
+        self.state = {
+            'target_table': target_table,
+            'endpoint': data_key,
+            'params': params,
+            'pages': None,
+            'completed_pages': [],
+            'last_completed_page': 0,
+        }
+        if os.path.exists(self.state_file):
+            try:
+                self.state = load_file(self.state_file)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable checkpoint {self.key}: {e}")
+
+    @property
+    def pages(self):
+        return self.state['pages']
+
+    # Total number of records reported by the API when the pages were fetched
+    @property
+    def total(self):
+        return self.state.get('total')
+
+    @property
+    def completed_pages(self):
+        return set(self.state['completed_pages'])
+
+    def page_file(self, page):
+        return os.path.join(self.path, f"page_{page:05d}.json")
+
+    # Write to a temporary file first, so a crash never leaves a half-written file behind
+    def _write(self, file_name, content):
+        temporary_file = file_name + '.tmp'
+        with open(temporary_file, 'wb') as f:
+            f.write(dumps_bytes(content))
+        os.replace(temporary_file, file_name)
+
+    def save_page(self, page, records, pages, total=None):
+        os.makedirs(self.path, exist_ok=True)
+        self._write(self.page_file(page), records)
+        with self.lock:
+            completed_pages = self.completed_pages | {page}
+            last_completed_page = self.state['last_completed_page']
+            while last_completed_page + 1 in completed_pages:
+                last_completed_page += 1
+            self.state['pages'] = pages
+            if total is not None:
+                self.state['total'] = total
+            self.state['completed_pages'] = sorted(completed_pages)
+            self.state['last_completed_page'] = last_completed_page
+            self.state['updated_at'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self._write(self.state_file, self.state)
+
+    def load_page(self, page):
+        return load_file(self.page_file(page))
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
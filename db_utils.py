@@ -0,0 +1,48 @@
+import os
+import threading
+import pyodbc
+from sqlalchemy import create_engine
+from dotenv import load_dotenv
+from params import DB_POOL_SIZE
+
+load_dotenv()
+
+# Database connection details
+server = os.getenv('DB_SERVER')
+database = os.getenv('DB_DATABASE')
+schema_name = os.getenv('DB_SCHEMA')
+username = os.getenv('DB_USERNAME')
+password = os.getenv('DB_PASSWORD')
+
+connection_string = f"mssql+pyodbc://{username}:{password}@{server}/{database}?driver=ODBC+Driver+17+for+SQL+Server"
+
+# Maximum number of Ids inlined in a single IN (...) clause
+ID_CHUNK_SIZE = 1000
+
+_engine = None
+_engine_lock = threading.Lock()
+
+# Function to establish the database connection
+def get_database_connection():
+    conn_str = (
+        'DRIVER={SQL Server};SERVER=' + server +
+        ';DATABASE=' + database +
+        ';UID=' + '{' + username + '}' +
+        ';PWD=' + '{' + password + '}'
+    )
+    return pyodbc.connect(conn_str)
+
+# Function to get the SQLAlchemy engine shared by the whole process
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            # Sized so that every table of the batches loaded in parallel gets its own connection
+            _engine = create_engine(connection_string, pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE, pool_pre_ping=True)
+    return _engine
+
+# Function to split a list of Ids into chunks that fit in an IN (...) clause
+def chunk_ids(ids, size=ID_CHUNK_SIZE):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
@@ -0,0 +1,93 @@
+import sys
+import datetime
+import pandas as pd
+from local_cache import (
+    EXPENSE_DETAIL_COLUMNS, lookup_report_id, update_expense_details, get_expense_details,
+    delete_expense_details, prune_expense_details, clear_complete_expense_details,
+)
+from params import DETAIL_CACHE_ENABLED, DETAIL_CACHE_DAYS
+
+# Local copy of the expense detail of reporte_rindegastos_detalle for the recent window, kept in the local cache.
+# The loaders write the detail of every batch of expenses they store, so the detail of a report can be read with an
+# indexed lookup by ReportId (or ReportNumber through the report index) instead of joining rindegastos_gastos and
+# rindegastos_gastos_extrafields on the shared server. Only reports marked as complete replace the database.
+
+# Columns of reporte_rindegastos_detalle that come from each expense and its extrafields
+detail_columns = {
+    'Id': 'ExpenseId',
+    'IssueDate': 'Gasto_Fecha',
+    'Serie_Value': 'Serie_Value',
+    'Correlativo_Value': 'Correlativo_Value',
+    'Category': 'Gasto_Categoria',
+    'CategoryCode': 'Gasto_Cuenta_id',
+    'Centro_Costo_Code': 'Centro_costo_code',
+    'Tipo_Documento_Value': 'Tipo_Documento_Value',
+    'RUC_Proveedor_Value': 'RUC_Proveedor_Value',
+    'Supplier': 'Gasto_Proveedor',
+    'Impuesto_Code': 'Impuesto_Code',
+    'Status': 'Gasto_Estado',
+    'Net': 'Gasto_Monto_neto',
+    'Tax': 'Gasto_Impuesto',
+    'OtherTaxes': 'Gasto_Otros_impuestos',
+    'Total': 'Gasto_Monto_Total',
+}
+
+expense_status_decode = {0: 'En Proceso', 1: 'Aprobado', 2: 'Rechazado'}
+
+# Function to build the values of reporte_rindegastos_detalle from the expenses of the API and their extrafields
+def build_detail_df(expenses_df, extrafields_df):
+    extrafields_columns = ['Id', 'Serie_Value', 'Correlativo_Value', 'Centro_Costo_Code', 'Tipo_Documento_Value', 'RUC_Proveedor_Value', 'Impuesto_Code']
+    if extrafields_df is None:
+        extrafields_df = pd.DataFrame(columns=extrafields_columns)
+    extrafields_df = extrafields_df.reindex(columns=extrafields_columns).drop_duplicates(subset='Id', keep='last')
+    expense_columns = [column for column in detail_columns if column not in extrafields_columns or column == 'Id']
+
+    detail_df = expenses_df.reindex(columns=expense_columns).merge(extrafields_df, on='Id', how='left')
+    detail_df = detail_df[list(detail_columns)].rename(columns=detail_columns)
+    detail_df['Gasto_Estado'] = detail_df['Gasto_Estado'].astype(object).map(expense_status_decode)
+    return detail_df
+
+# Function to write the detail of a batch of expenses to the cache. complete_report_ids are the reports whose
+# every expense is in the batch. A failed write makes every report fall back to the database.
+def sync_expense_details(expenses_df, extrafields_df, complete_report_ids=()):
+    if not DETAIL_CACHE_ENABLED or expenses_df.empty:
+        return
+    try:
+        detail_df = build_detail_df(expenses_df, extrafields_df)
+        detail_df.insert(1, 'ReportId', expenses_df['ReportId'].values if 'ReportId' in expenses_df.columns else None)
+        detail_df = detail_df[EXPENSE_DETAIL_COLUMNS].astype(object)
+        detail_df = detail_df.where(detail_df.notna(), None)
+        update_expense_details(detail_df.itertuples(index=False, name=None), complete_report_ids)
+    except Exception as e:
+        print(f"Error updating the expense detail cache: {e}")
+        clear_complete_expense_details()
+
+# Function to remove from the cache the detail of expenses deleted from the database
+def remove_expense_details(expense_ids):
+    if DETAIL_CACHE_ENABLED:
+        delete_expense_details(expense_ids)
+
+# Function to drop the detail of the expenses issued before the window of DETAIL_CACHE_DAYS days
+def prune_detail_cache():
+    if DETAIL_CACHE_ENABLED:
+        prune_expense_details((datetime.date.today() - datetime.timedelta(days=DETAIL_CACHE_DAYS)).isoformat())
+
+# Function to get the cached detail of a report by ReportId or ReportNumber, or None if the report is not fully cached
+def get_report_detail(report_id=None, report_number=None):
+    if not DETAIL_CACHE_ENABLED:
+        return None
+    if report_id is None:
+        report_id = lookup_report_id(report_number)
+        if report_id is None:
+            return None
+    rows, complete = get_expense_details(report_id)
+    if not complete:
+        return None
+    return pd.DataFrame(rows, columns=EXPENSE_DETAIL_COLUMNS)
+
+if __name__ == "__main__":
+    detail_df = get_report_detail(report_number=int(sys.argv[1]))
+    if detail_df is None:
+        print(f"Report {sys.argv[1]} is not in the local cache")
+    else:
+        print(detail_df.to_string(index=False))
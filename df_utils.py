@@ -0,0 +1,115 @@
+import time
+import numpy as np
+import pandas as pd
+from json_codec import dumps
+
+# Columns returned by the Rindegastos API that always hold lists or dictionaries
+KNOWN_NESTED_COLUMNS = {'ExtraFields', 'SunatInfo', 'Files'}
+
+# Function to serialize a list or dictionary as JSON, leaving any other value untouched
+def serialize_value(value):
+    if isinstance(value, (list, dict)):
+        return dumps(value)
+    return value
+
+# Function to detect which columns hold lists or dictionaries.
+# Only object columns are inspected and only through their first non-null value,
+# so the cost depends on the number of columns and not on the number of cells.
+def find_nested_columns(df):
+    nested_columns = []
+    for column in df.columns:
+        if column in KNOWN_NESTED_COLUMNS:
+            nested_columns.append(column)
+            continue
+        series = df[column]
+        if series.dtype != object:
+            continue
+        first_index = series.first_valid_index()
+        if first_index is not None and isinstance(series.loc[first_index], (list, dict)):
+            nested_columns.append(column)
+    return nested_columns
+
+# Function to serialize only the nested columns of a DataFrame as JSON strings
+def serialize_nested_columns(df, nested_columns=None):
+    if nested_columns is None:
+        nested_columns = find_nested_columns(df)
+    nested_columns = [column for column in nested_columns if column in df.columns]
+    if not nested_columns:
+        return df
+    df = df.copy(deep=False)
+    for column in nested_columns:
+        df[column] = df[column].map(serialize_value)
+    return df
+
+# Function to convert the columns of a DataFrame to the compact dtypes of its schema.
+# Columns that cannot be converted without losing data keep their original dtype.
+def apply_schema(df, schema):
+    df = df.copy(deep=False)
+    for column, kind in schema.items():
+        if column not in df.columns:
+            continue
+        try:
+            if kind == 'category':
+                df[column] = df[column].astype('category')
+            elif kind == 'float':
+                df[column] = pd.to_numeric(df[column]).astype('float64')
+            else:
+                df[column] = pd.to_numeric(df[column]).astype(kind)
+        except (TypeError, ValueError) as e:
+            print(f"Keeping {column} as {df[column].dtype}, could not convert to {kind}: {e}")
+    return df
+
+# Function to print the memory used by a DataFrame before and after applying its schema
+def memory_report(df_before, df_after, label):
+    before = df_before.memory_usage(deep=True).sum() / 1024 ** 2
+    after = df_after.memory_usage(deep=True).sum() / 1024 ** 2
+    reduction = (1 - after / before) * 100 if before else 0
+    print(f"Memory of {label}: {before:.1f} MB -> {after:.1f} MB ({reduction:.0f}% less, {len(df_after)} rows)")
+
+# Function to build a synthetic DataFrame with the shape of a page of expenses
+def build_benchmark_frame(n_rows):
+    rng = np.random.default_rng(0)
+    data = {
+        'Id': np.arange(n_rows),
+        'Status': rng.integers(0, 3, n_rows),
+        'Supplier': [f"Proveedor {i % 500}" for i in range(n_rows)],
+        'IssueDate': ['2025-01-15'] * n_rows,
+        'Currency': ['PEN'] * n_rows,
+        'Category': [f"Categoria {i % 40}" for i in range(n_rows)],
+        'Net': rng.random(n_rows) * 1000,
+        'Tax': rng.random(n_rows) * 180,
+        'Total': rng.random(n_rows) * 1180,
+        'ReportId': rng.integers(1, 5000, n_rows),
+    }
+    for i in range(20):
+        data[f"Campo_{i}"] = [f"valor {j % 100}" for j in range(n_rows)]
+    data['ExtraFields'] = [
+        [{'Name': 'Serie', 'Value': f"F00{i % 9}", 'Code': ''}, {'Name': 'Correlativo', 'Value': str(i), 'Code': ''}]
+        for i in range(n_rows)
+    ]
+    data['SunatInfo'] = [{'businessName': f"Proveedor {i % 500}", 'ubigeo': '150101'} for i in range(n_rows)]
+    data['Files'] = [[{'Name': f"archivo_{i}.pdf"}] for i in range(n_rows)]
+    return pd.DataFrame(data)
+
+# Function to compare the per-cell transformation against the serialization of nested columns only
+def benchmark_serialization(n_rows=20000, repeat=3):
+    df = build_benchmark_frame(n_rows)
+    legacy = lambda cell: str(cell) if isinstance(cell, (list, dict)) else cell
+
+    timings = {'df.map(transform_to_string)': [], 'serialize_nested_columns': []}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df.map(legacy).drop_duplicates()
+        timings['df.map(transform_to_string)'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        serialize_nested_columns(df).drop_duplicates()
+        timings['serialize_nested_columns'].append(time.perf_counter() - start)
+
+    print(f"Benchmark with {n_rows} rows and {len(df.columns)} columns (best of {repeat}):")
+    for name, values in timings.items():
+        print(f"  {name}: {min(values):.3f} seconds")
+    return timings
+
+if __name__ == "__main__":
+    benchmark_serialization()
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import requests
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cargar_rindegastos import store_batch, build_extrafields_df
+from actualizar_informe_y_gastos_rindegastos import fetch_from_rindegastos, parse_extrafields, update_report_tables
+from api_utils import run_concurrently, RINDEGASTOS_LIMITER
+from change_detection import delete_records, clear_seen_ids, ensure_tracking_tables
+from change_log import start_new_run, record_changes, execute_report_refresh
+from db_utils import get_database_connection, chunk_ids, schema_name
+from detail_cache import remove_expense_details
+from json_codec import loads
+from dotenv import load_dotenv
+from params import INCREMENTAL_LOAD, REPORT_REFRESH_MODE, LISTENER_PORT, LISTENER_BATCH_SECONDS, LISTENER_BATCH_MAX
+
+load_dotenv()
+
+# Shared secret expected in the X-Webhook-Token header of the notifications. Without it the listener only
+# accepts notifications from the same machine.
+webhook_secret = os.getenv('WEBHOOK_SECRET')
+
+# Near-real-time loads: change notifications of expenses and reports are collected for LISTENER_BATCH_SECONDS
+# seconds (or until LISTENER_BATCH_MAX Ids arrive), then the affected records are fetched from the API and upserted
+# through the same path as the daily load.
+#
+# A notification is a JSON object, or a list of them, with the Ids that changed:
+#   {"ExpenseId": 123}, {"ReportId": 456} or {"ExpenseIds": [1, 2], "ReportIds": [3]}
+
+# Function to read the expense and report Ids of a notification
+def parse_notification(payload):
+    expense_ids, report_ids = set(), set()
+    for event in payload if isinstance(payload, list) else [payload]:
+        if not isinstance(event, dict):
+            raise ValueError(f"Invalid notification: {event!r}")
+        if event.get('ExpenseId') is not None:
+            expense_ids.add(int(event['ExpenseId']))
+        if event.get('ReportId') is not None:
+            report_ids.add(int(event['ReportId']))
+        expense_ids.update(int(expense_id) for expense_id in event.get('ExpenseIds', []))
+        report_ids.update(int(report_id) for report_id in event.get('ReportIds', []))
+    return expense_ids, report_ids
+
+# Collects the Ids of the notifications and hands them to flush_function in micro-batches
+class MicroBatcher:
+    def __init__(self, flush_function, window_seconds=LISTENER_BATCH_SECONDS, max_ids=LISTENER_BATCH_MAX):
+        self.flush_function = flush_function
+        self.window_seconds = window_seconds
+        self.max_ids = max_ids
+        self.expense_ids = set()
+        self.report_ids = set()
+        self.first_received = None
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def add(self, expense_ids, report_ids):
+        with self.condition:
+            self.expense_ids.update(expense_ids)
+            self.report_ids.update(report_ids)
+            if self.first_received is None:
+                self.first_received = time.monotonic()
+            self.condition.notify_all()
+
+    # Function to wait until the window of the first pending notification closes or the batch is full
+    def _take_batch(self):
+        with self.condition:
+            while not self.stopped:
+                pending = len(self.expense_ids) + len(self.report_ids)
+                if pending and (pending >= self.max_ids or time.monotonic() - self.first_received >= self.window_seconds):
+                    break
+                timeout = self.window_seconds - (time.monotonic() - self.first_received) if pending else None
+                self.condition.wait(timeout)
+            batch = (self.expense_ids, self.report_ids)
+            self.expense_ids, self.report_ids, self.first_received = set(), set(), None
+            return batch
+
+    def run(self):
+        while not self.stopped:
+            expense_ids, report_ids = self._take_batch()
+            if expense_ids or report_ids:
+                try:
+                    self.flush_function(expense_ids, report_ids)
+                except Exception as e:
+                    # The Ids are lost for this batch; the daily load still picks up the changes
+                    print(f"Error loading the batch of {len(expense_ids)} expenses and {len(report_ids)} reports: {e}")
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+# Function to get the Ids of the expenses stored for each report, as {ReportId: {Id, ...}}
+def get_stored_report_expenses(report_ids):
+    stored_expenses = {report_id: set() for report_id in report_ids}
+    conn = get_database_connection()
+    cursor = conn.cursor()
+    try:
+        for chunk in chunk_ids(sorted(report_ids)):
+            cursor.execute(f"SELECT Id, ReportId FROM {schema_name}.rindegastos_gastos WHERE ReportId IN ({','.join(map(str, chunk))})")
+            for expense_id, report_id in cursor.fetchall():
+                stored_expenses[report_id].add(expense_id)
+    finally:
+        cursor.close()
+        conn.close()
+    return stored_expenses
+
+# Function to fetch the changed expenses and reports from the API and upsert them
+def load_changes(expense_ids, report_ids):
+    start_new_run()
+    # The Ids seen by a flush are only meaningful for that flush
+    clear_seen_ids()
+    print(f"Loading {len(expense_ids)} expenses and {len(report_ids)} reports")
+
+    reports = [report for report in run_concurrently(
+        lambda report_id: fetch_from_rindegastos("getExpenseReport", params={"Id": report_id}),
+        sorted(report_ids),
+        RINDEGASTOS_LIMITER,
+    ) if report]
+    # Every expense of a changed report is loaded again, together with the expenses notified on their own
+    report_expenses = run_concurrently(
+        lambda report_id: fetch_from_rindegastos("getExpenses", params={"ReportId": report_id}),
+        sorted(report_ids),
+        RINDEGASTOS_LIMITER,
+    )
+    # Reports whose expenses could not be fetched are left as they are
+    report_expenses = {report_id: data.get('Expenses', []) for report_id, data in zip(sorted(report_ids), report_expenses) if data is not None}
+    expenses = {expense['Id']: expense for report_expense_list in report_expenses.values() for expense in report_expense_list}
+    missing_expense_ids = sorted(expense_ids - set(expenses))
+    for expense in run_concurrently(
+        lambda expense_id: fetch_from_rindegastos("getExpense", params={"Id": expense_id}),
+        missing_expense_ids,
+        RINDEGASTOS_LIMITER,
+    ):
+        if expense:
+            expenses[expense['Id']] = expense
+
+    # As in the report refresh, the stored expenses that no longer belong to a changed report are deleted
+    stored_expenses = get_stored_report_expenses(report_expenses) if report_expenses else {}
+    removed_expenses = {report_id: ids - {expense['Id'] for expense in report_expenses[report_id]} for report_id, ids in stored_expenses.items()}
+    # An expense moved to another report of the batch is stored again with its new report
+    removed_ids = set().union(*removed_expenses.values()) - set(expenses)
+    if removed_ids:
+        delete_records('rindegastos_gastos', removed_ids, include_hashes=True)
+        record_changes('rindegastos_gastos', removed_ids, 'D')
+        remove_expense_details(removed_ids)
+        print(f"Deleted {len(removed_ids)} expenses no longer in their reports: {sorted(removed_ids)}")
+
+    for target_table, data_key, records in [
+        ('rindegastos_gastos', 'Expenses', list(expenses.values())),
+        ('rindegastos_informes', 'ExpenseReports', reports),
+    ]:
+        if not records:
+            continue
+        # The single-record endpoints may return ExtraFields as a JSON string, as in the report refresh
+        for record in records:
+            if 'ExtraFields' in record:
+                record['ExtraFields'] = parse_extrafields(record['ExtraFields'])
+        if not INCREMENTAL_LOAD:
+            # Without change detection the previous version of the records is deleted first
+            delete_records(target_table, [record['Id'] for record in records])
+        store_batch(records, target_table, data_key, "1")
+
+    # The full refresh is left to the scheduled loads; the incremental one only covers the Ids of this batch.
+    # Otherwise the detail and summary of the changed reports are updated as in the report refresh.
+    if REPORT_REFRESH_MODE == 'incremental':
+        execute_report_refresh()
+    else:
+        for report in [report for report in reports if report['Id'] in report_expenses]:
+            expenses_df = pd.DataFrame(report_expenses[report['Id']])
+            extrafields_df = build_extrafields_df(expenses_df[['Id', 'ExtraFields']], 'rindegastos_gastos_extrafields') if 'ExtraFields' in expenses_df.columns else None
+            update_report_tables(report, report['ReportNumber'], expenses_df, extrafields_df, removed_expenses.get(report['Id'], set()))
+
+# Handler of the webhook notifications
+class NotificationHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def do_POST(self):
+        if webhook_secret and self.headers.get('X-Webhook-Token') != webhook_secret:
+            self.send_error(401)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            expense_ids, report_ids = parse_notification(loads(self.rfile.read(length)))
+        except (ValueError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        self.batcher.add(expense_ids, report_ids)
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} - {format % args}")
+
+# Function to listen for notifications until the process is stopped
+def listen(port=LISTENER_PORT, flush_function=load_changes):
+    if INCREMENTAL_LOAD:
+        ensure_tracking_tables()
+    batcher = MicroBatcher(flush_function)
+    NotificationHandler.batcher = batcher
+    host = '0.0.0.0' if webhook_secret else '127.0.0.1'
+    server = ThreadingHTTPServer((host, port), NotificationHandler)
+    worker = threading.Thread(target=batcher.run, daemon=True)
+    worker.start()
+    if not webhook_secret:
+        print("WEBHOOK_SECRET is not set: only notifications from this machine are accepted")
+    print(f"Listening for Rindegastos notifications on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+        worker.join()
+
+# Function to send a notification to a listener, as a local stand-in for the real sender
+def simulate(port, expense_ids, report_ids):
+    headers = {"X-Webhook-Token": webhook_secret} if webhook_secret else {}
+    response = requests.post(f"http://localhost:{port}/", json={"ExpenseIds": expense_ids, "ReportIds": report_ids}, headers=headers, timeout=10)
+    print(f"Listener answered {response.status_code}")
+    return response.status_code == 202
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carga casi en tiempo real los gastos e informes notificados por Rindegastos")
+    parser.add_argument('--puerto', type=int, default=LISTENER_PORT, help="Puerto en que se reciben las notificaciones")
+    parser.add_argument('--simular', action='store_true', help="Envía una notificación de prueba a un listener local en vez de escuchar")
+    parser.add_argument('--gastos', type=int, nargs='*', default=[], help="Ids de gastos de la notificación de prueba")
+    parser.add_argument('--informes', type=int, nargs='*', default=[], help="Ids de informes de la notificación de prueba")
+    args = parser.parse_args()
+
+    if args.simular:
+        sys.exit(0 if simulate(args.puerto, args.gastos, args.informes) else 1)
+    listen(args.puerto)
@@ -0,0 +1,122 @@
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from params import JSON_BACKEND
+
+# Single entry point for the JSON work of the loaders. orjson is used when it is installed (and JSON_BACKEND allows it),
+# otherwise the standard library. Both backends read bytes directly and write the same compact, non-ASCII-escaped text.
+# Inputs orjson rejects but the standard library accepts (NaN literals, integers over 64 bits, a UTF-8 BOM, dictionary
+# keys that are not strings) fall back to the standard library, so the backend never changes what is accepted.
+# This module only depends on the standard library and params, so the transform worker processes can import it.
+BACKEND = 'orjson' if orjson is not None and JSON_BACKEND != 'json' else 'json'
+
+# Error raised by loads for invalid JSON, whatever the backend (orjson.JSONDecodeError is a subclass)
+DecodeError = json.JSONDecodeError
+
+# Function to decode JSON from bytes or str
+def loads(data):
+    if BACKEND == 'orjson':
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+# Function to encode a value as compact JSON bytes, converting unknown types with default
+def dumps_bytes(value, default=str, sort_keys=False):
+    if BACKEND == 'orjson':
+        try:
+            # Dates and dataclasses go through default, as in the standard library
+            option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+            return orjson.dumps(value, default=default, option=option | orjson.OPT_SORT_KEYS if sort_keys else option)
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=default, sort_keys=sort_keys).encode('utf-8')
+
+# Function to encode a value as compact JSON text
+def dumps(value, default=str, sort_keys=False):
+    if BACKEND == 'orjson':
+        return dumps_bytes(value, default, sort_keys).decode('utf-8')
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=default, sort_keys=sort_keys)
+
+# Function to read a JSON file
+def load_file(file_name):
+    with open(file_name, 'rb') as f:
+        return loads(f.read())
+
+# Function to build a page of expenses with the shape returned by getExpenses, for the benchmark
+def sample_expense_page(records=1000):
+    extracted_data = json.dumps({'data': {'estadoCp': '1', 'estadoRuc': '00', 'condDomiRuc': '00', 'observaciones': []}})
+    expenses = []
+    for record_id in range(records):
+        expenses.append({
+            'Id': 40000000 + record_id, 'Status': 1, 'Supplier': 'Compañía Minera Ñandú S.A.C.', 'IssueDate': '2025-03-14',
+            'OriginalAmount': 1180.5, 'Currency': 'PEN', 'Net': 1000.42, 'Tax': 180.08, 'OtherTaxes': 0, 'Total': 1180.5,
+            'Category': 'Alimentación', 'CategoryCode': '6371101', 'ReportId': 900000 + record_id // 20, 'UserId': 1234,
+            'Note': 'Almuerzo con cliente en Arequipa',
+            'ExtraFields': [{'Name': name, 'Value': f'{name} {record_id}', 'Code': f'{record_id:06d}'} for name in
+                            ['Serie', 'Correlativo', 'Centro Costo', 'Tipo Documento', 'RUC Proveedor', 'Impuesto']],
+            'SunatInfo': {'status': 'ok', 'ruc': '20100070970', 'extractedData': json.dumps(extracted_data)},
+            'Files': [{'Name': 'boleta.pdf', 'Url': f'https://files.rindegastos.com/{record_id}.pdf'}],
+        })
+    return {'Records': {'Start': 0, 'Limit': records, 'Total': records, 'Pages': 1}, 'Expenses': expenses}
+
+# Function to time func over repeat runs and return the best time in milliseconds
+def best_time(func, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+# Function to compare the backends on the JSON work of the loaders. It uses the checkpoint pages given as arguments
+# (checkpoints/<key>/page_XXXXX.json) or a sample page of expenses.
+def benchmark(page_files=()):
+    global BACKEND
+    from stream_records import StreamedPage, STREAM_CHUNK_SIZE
+
+    if page_files:
+        pages = [{'Expenses': load_file(file_name)} for file_name in page_files]
+    else:
+        pages = [sample_expense_page()]
+    page_bytes = [json.dumps(page).encode('utf-8') for page in pages]
+    expenses = [expense for page in pages for expense in page['Expenses']]
+    extra_fields = [expense['ExtraFields'] for expense in expenses if expense.get('ExtraFields')]
+    extracted_data = [expense['SunatInfo']['extractedData'] for expense in expenses if isinstance(expense.get('SunatInfo'), dict) and expense['SunatInfo'].get('extractedData')]
+    sunat_payload = {'numRuc': '20100070970', 'codComp': '01', 'numeroSerie': 'F001', 'numero': '123', 'fechaEmision': '14/03/2025', 'monto': '1180.50'}
+    size_mb = sum(map(len, page_bytes)) / 1024 / 1024
+
+    cases = {
+        'page decode (whole)': lambda: [loads(data) for data in page_bytes],
+        'page decode (streamed)': lambda: [list(StreamedPage((data[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(data), STREAM_CHUNK_SIZE)), 'Expenses')) for data in page_bytes],
+        'ExtraFields serialize': lambda: [dumps(value) for value in extra_fields],
+        'ExtraFields parse': lambda: [loads(value) for value in map(dumps, extra_fields)],
+        'extractedData parse': lambda: [loads(loads(value)) for value in extracted_data],
+        'SUNAT payload x1000': lambda: [dumps_bytes(sunat_payload) for _ in range(1000)],
+        'checkpoint page write': lambda: [dumps_bytes(page['Expenses']) for page in pages],
+    }
+    backends = ['json'] + (['orjson'] if orjson is not None else [])
+    print(f"{len(expenses)} records in {len(pages)} pages ({size_mb:.1f} MB)")
+    print(f"{'case':<26}" + ''.join(f"{backend:>12}" for backend in backends))
+    selected_backend = BACKEND
+    try:
+        for name, func in cases.items():
+            timings = []
+            for backend in backends:
+                BACKEND = backend
+                timings.append(best_time(func))
+            print(f"{name:<26}" + ''.join(f"{timing:>10.1f}ms" for timing in timings))
+    finally:
+        BACKEND = selected_backend
+    if orjson is None:
+        print("orjson is not installed; only the standard library was measured")
+
+if __name__ == "__main__":
+    import sys
+    benchmark(sys.argv[1:])
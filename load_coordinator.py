@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect, text, bindparam
+from db_utils import get_engine, chunk_ids, schema_name
+from profiling import profile_workers
+from params import DB_LOCK_TIMEOUT_SECONDS
+
+# Only one batch of the process writes at a time. The transaction of each table stays open until its sibling tables
+# finish, so two batches writing the same tables at once could wait on each other through idle sessions, a cycle
+# the deadlock monitor of SQL Server does not detect.
+_write_lock = threading.Lock()
+
+# Function to write the tables of a batch concurrently, each one on its own pooled connection and transaction.
+# The transactions are committed one after another once every write has finished, and if any write fails all of
+# them are rolled back. This is best effort: a failure during the commits themselves can leave the tables committed
+# before it loaded. A lock wait longer than DB_LOCK_TIMEOUT_SECONDS (such as one on a batch of another process)
+# fails the write, so the batch is rolled back instead of waiting forever.
+# upsert_keys maps a table to its key column: the rows with the same keys are deleted in the same transaction first.
+# delete_ids maps a table to Ids whose rows are deleted in its transaction before the write, even if the batch
+# has no rows for the table (such as the related rows of a changed record that no longer has them).
+def write_tables_concurrently(frames, schema=schema_name, engine=None, upsert_keys=None, delete_ids=None):
+    engine = engine or get_engine()
+    frames = {table: df for table, df in frames.items() if df is not None and not df.empty}
+    delete_ids = {table: list(ids) for table, ids in (delete_ids or {}).items() if len(ids)}
+    tables = list(frames) + [table for table in delete_ids if table not in frames]
+    if not tables:
+        return
+
+    with _write_lock:
+        write_tables(frames, tables, schema, engine, upsert_keys, delete_ids)
+
+# Function to write the tables of a batch, see write_tables_concurrently
+def write_tables(frames, tables, schema, engine, upsert_keys, delete_ids):
+    connections = {}
+    transactions = {}
+
+    def write_table(table):
+        conn = engine.connect()
+        connections[table] = conn
+        transactions[table] = conn.begin()
+        if engine.dialect.name == 'mssql':
+            conn.exec_driver_sql(f"SET LOCK_TIMEOUT {DB_LOCK_TIMEOUT_SECONDS * 1000}")
+        if table in delete_ids:
+            delete_query = text(f"DELETE FROM {schema}.{table} WHERE Id IN :ids").bindparams(bindparam('ids', expanding=True))
+            for chunk in chunk_ids(delete_ids[table]):
+                conn.execute(delete_query, {'ids': chunk})
+        if table not in frames:
+            return
+        key_column = (upsert_keys or {}).get(table)
+        if key_column is not None and inspect(conn).has_table(table, schema=schema):
+            delete_query = text(f"DELETE FROM {schema}.{table} WHERE {key_column} IN :keys").bindparams(bindparam('keys', expanding=True))
+            for chunk in chunk_ids(frames[table][key_column].unique().tolist()):
+                conn.execute(delete_query, {'keys': chunk})
+        frames[table].to_sql(table, conn, schema=schema, if_exists='append', index=False)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        futures = {table: executor.submit(profile_workers(write_table), table) for table in tables}
+        for table, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error writing {table}: {e}")
+                errors.append(e)
+
+    try:
+        if errors:
+            for transaction in transactions.values():
+                transaction.rollback()
+            raise errors[0]
+        # Commit point of the batch
+        for transaction in transactions.values():
+            transaction.commit()
+        if frames:
+            print(f"Stored {', '.join(f'{len(df)} rows in {table}' for table, df in frames.items())}")
+    finally:
+        for conn in connections.values():
+            conn.close()
@@ -0,0 +1,237 @@
+import sqlite3
+import datetime
+from params import LOCAL_CACHE_PATH, RUC_STATUS_TTL_HOURS
+
+# Local SQLite file shared by the scripts running on the same server.
+# It only holds data that can be rebuilt from Rindegastos or the database, so it can be deleted at any time.
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS reference_fingerprints (
+        entity TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS report_index (
+        ReportNumber INTEGER PRIMARY KEY,
+        Id INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS ruc_status (
+        ruc TEXT PRIMARY KEY,
+        estado_contribuyente TEXT NOT NULL,
+        condicion_domiciliaria TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS backfill_units (
+        unit TEXT PRIMARY KEY,
+        completed_at TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS expense_detail (
+        ExpenseId INTEGER PRIMARY KEY,
+        ReportId INTEGER,
+        Gasto_Fecha TEXT,
+        Serie_Value TEXT,
+        Correlativo_Value TEXT,
+        Gasto_Categoria TEXT,
+        Gasto_Cuenta_id TEXT,
+        Centro_costo_code TEXT,
+        Tipo_Documento_Value TEXT,
+        RUC_Proveedor_Value TEXT,
+        Gasto_Proveedor TEXT,
+        Impuesto_Code TEXT,
+        Gasto_Estado TEXT,
+        Gasto_Monto_neto REAL,
+        Gasto_Impuesto REAL,
+        Gasto_Otros_impuestos REAL,
+        Gasto_Monto_Total REAL,
+        updated_at TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS expense_detail_report ON expense_detail (ReportId)',
+    'CREATE INDEX IF NOT EXISTS report_index_id ON report_index (Id)',
+    # Reports whose every expense was written to expense_detail, so their cached detail can replace the database
+    '''CREATE TABLE IF NOT EXISTS expense_detail_reports (
+        ReportId INTEGER PRIMARY KEY,
+        updated_at TEXT NOT NULL
+    )''',
+]
+
+# Columns of expense_detail, in the order of the rows received by update_expense_details
+EXPENSE_DETAIL_COLUMNS = [
+    'ExpenseId', 'ReportId', 'Gasto_Fecha', 'Serie_Value', 'Correlativo_Value', 'Gasto_Categoria', 'Gasto_Cuenta_id',
+    'Centro_costo_code', 'Tipo_Documento_Value', 'RUC_Proveedor_Value', 'Gasto_Proveedor', 'Impuesto_Code',
+    'Gasto_Estado', 'Gasto_Monto_neto', 'Gasto_Impuesto', 'Gasto_Otros_impuestos', 'Gasto_Monto_Total',
+]
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Function to open the local cache, creating its tables when needed
+def get_local_connection():
+    conn = sqlite3.connect(LOCAL_CACHE_PATH, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+# Function to get the fingerprint of the last payload stored for an entity and its age in hours
+def get_fingerprint(entity):
+    conn = get_local_connection()
+    try:
+        row = conn.execute('SELECT fingerprint, updated_at FROM reference_fingerprints WHERE entity = ?', (entity,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None, None
+    updated_at = datetime.datetime.strptime(row[1], DATETIME_FORMAT)
+    return row[0], (datetime.datetime.now() - updated_at).total_seconds() / 3600
+
+# Function to save the fingerprint of the payload just stored for an entity
+def set_fingerprint(entity, fingerprint):
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO reference_fingerprints (entity, fingerprint, updated_at) VALUES (?, ?, ?)',
+                (entity, fingerprint, datetime.datetime.now().strftime(DATETIME_FORMAT)),
+            )
+    finally:
+        conn.close()
+
+# Function to save ReportNumber -> Id pairs in the report index
+def update_report_index(pairs):
+    updated_at = datetime.datetime.now().strftime(DATETIME_FORMAT)
+    rows = [(int(report_number), int(report_id), updated_at) for report_number, report_id in pairs]
+    if not rows:
+        return
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO report_index (ReportNumber, Id, updated_at) VALUES (?, ?, ?)', rows)
+    finally:
+        conn.close()
+
+# Function to get the Id of a report from its ReportNumber, or None if it is not in the index
+def lookup_report_id(report_number):
+    conn = get_local_connection()
+    try:
+        row = conn.execute('SELECT Id FROM report_index WHERE ReportNumber = ?', (int(report_number),)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+# Function to get the taxpayer status learned from SUNAT for each RUC within the TTL, as {ruc: (estado, condicion)}
+def get_ruc_statuses(max_age_hours=RUC_STATUS_TTL_HOURS):
+    since = (datetime.datetime.now() - datetime.timedelta(hours=max_age_hours)).strftime(DATETIME_FORMAT)
+    conn = get_local_connection()
+    try:
+        rows = conn.execute(
+            'SELECT ruc, estado_contribuyente, condicion_domiciliaria FROM ruc_status WHERE updated_at >= ?', (since,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return {ruc: (estado, condicion) for ruc, estado, condicion in rows}
+
+# Function to save (ruc, estado_contribuyente, condicion_domiciliaria) tuples learned from SUNAT
+def update_ruc_statuses(statuses):
+    updated_at = datetime.datetime.now().strftime(DATETIME_FORMAT)
+    rows = [(str(ruc), estado, condicion, updated_at) for ruc, estado, condicion in statuses]
+    if not rows:
+        return
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO ruc_status (ruc, estado_contribuyente, condicion_domiciliaria, updated_at) VALUES (?, ?, ?, ?)',
+                rows,
+            )
+    finally:
+        conn.close()
+
+# Function to get the units of the historical backfill that already finished
+def get_completed_backfill_units():
+    conn = get_local_connection()
+    try:
+        rows = conn.execute('SELECT unit FROM backfill_units').fetchall()
+    finally:
+        conn.close()
+    return {row[0] for row in rows}
+
+# Function to mark a unit of the historical backfill as finished
+def mark_backfill_unit_completed(unit):
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO backfill_units (unit, completed_at) VALUES (?, ?)',
+                (unit, datetime.datetime.now().strftime(DATETIME_FORMAT)),
+            )
+    finally:
+        conn.close()
+
+# Function to forget the finished units of the historical backfill, so they are loaded again
+def clear_backfill_units(units):
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.executemany('DELETE FROM backfill_units WHERE unit = ?', [(unit,) for unit in units])
+    finally:
+        conn.close()
+
+# Function to save expense detail rows (tuples in EXPENSE_DETAIL_COLUMNS order). The reports of complete_report_ids
+# are marked as fully cached, since all of their expenses are among the rows.
+def update_expense_details(rows, complete_report_ids=()):
+    updated_at = datetime.datetime.now().strftime(DATETIME_FORMAT)
+    rows = [tuple(row) + (updated_at,) for row in rows]
+    complete_rows = [(int(report_id), updated_at) for report_id in complete_report_ids]
+    columns = ', '.join(EXPENSE_DETAIL_COLUMNS + ['updated_at'])
+    placeholders = ', '.join('?' * (len(EXPENSE_DETAIL_COLUMNS) + 1))
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.executemany(f'INSERT OR REPLACE INTO expense_detail ({columns}) VALUES ({placeholders})', rows)
+            conn.executemany('INSERT OR REPLACE INTO expense_detail_reports (ReportId, updated_at) VALUES (?, ?)', complete_rows)
+    finally:
+        conn.close()
+
+# Function to get the cached detail rows of a report and whether every expense of the report is cached
+def get_expense_details(report_id):
+    conn = get_local_connection()
+    try:
+        rows = conn.execute(
+            f"SELECT {', '.join(EXPENSE_DETAIL_COLUMNS)} FROM expense_detail WHERE ReportId = ? ORDER BY ExpenseId", (int(report_id),)
+        ).fetchall()
+        complete = conn.execute('SELECT 1 FROM expense_detail_reports WHERE ReportId = ?', (int(report_id),)).fetchone() is not None
+    finally:
+        conn.close()
+    return rows, complete
+
+# Function to remove the cached detail of expenses deleted from the database
+def delete_expense_details(expense_ids):
+    rows = [(int(expense_id),) for expense_id in expense_ids]
+    if not rows:
+        return
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.executemany('DELETE FROM expense_detail WHERE ExpenseId = ?', rows)
+    finally:
+        conn.close()
+
+# Function to drop the detail of the expenses issued before a date. Their reports are no longer fully cached.
+def prune_expense_details(before):
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.execute(
+                'DELETE FROM expense_detail_reports WHERE ReportId IN (SELECT ReportId FROM expense_detail WHERE Gasto_Fecha < ?)', (before,)
+            )
+            conn.execute('DELETE FROM expense_detail WHERE Gasto_Fecha < ?', (before,))
+    finally:
+        conn.close()
+
+# Function to stop trusting the cached detail of every report, for example after a write to the cache failed
+def clear_complete_expense_details():
+    conn = get_local_connection()
+    try:
+        with conn:
+            conn.execute('DELETE FROM expense_detail_reports')
+    finally:
+        conn.close()
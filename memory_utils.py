@@ -0,0 +1,136 @@
+import os
+import sys
+import threading
+import tracemalloc
+from params import MEMORY_BUDGET_MB, MEMORY_WORKING_COPIES, PARTITION_WORKERS
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 ** 2
+
+# tracemalloc is shared by the whole process, so only one load measures its records at a time
+_measure_lock = threading.Lock()
+
+# Function to get the working set of a Windows process (current and peak, in bytes) through the Win32 API
+def _windows_memory_info():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ('cb', wintypes.DWORD),
+            ('PageFaultCount', wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t),
+        ]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None, None
+    return counters.WorkingSetSize, counters.PeakWorkingSetSize
+
+# Function to get the resident memory of the process in MB, or None if it cannot be measured
+def get_rss_mb():
+    try:
+        if psutil is not None:
+            return psutil.Process().memory_info().rss / MB
+        if sys.platform == 'win32':
+            current, _ = _windows_memory_info()
+            return current / MB if current is not None else None
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Function to get the peak resident memory of the process in MB, or None if it cannot be measured
+def get_peak_rss_mb():
+    try:
+        if sys.platform == 'win32':
+            _, peak = _windows_memory_info()
+            return peak / MB if peak is not None else None
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB on Linux
+        return peak / MB if sys.platform == 'darwin' else peak / 1024
+    except (OSError, ValueError, AttributeError, ImportError):
+        return None
+
+# Function to print the current and peak resident memory of the process
+def report_peak_rss(label):
+    current, peak = get_rss_mb(), get_peak_rss_mb()
+    if peak is None:
+        print(f"Peak memory of {label}: not available on this platform")
+        return
+    current = f"{current:.0f} MB" if current is not None else "unknown"
+    print(f"Memory of {label}: {current} in use, {peak:.0f} MB peak (budget {MEMORY_BUDGET_MB or 'unlimited'} MB)")
+
+# Sizes the batches of a load so that they fit in its share of MEMORY_BUDGET_MB.
+# The footprint per record is measured with tracemalloc while the first page of the load is read, nested lists and
+# dictionaries included, and the pipeline keeps about MEMORY_WORKING_COPIES copies of a batch (records, typed and
+# serialized frames, related tables) at the same time.
+class MemoryBudget:
+    def __init__(self, budget_mb=MEMORY_BUDGET_MB, share=PARTITION_WORKERS, copies=MEMORY_WORKING_COPIES):
+        self.budget_mb = budget_mb
+        self.budget_bytes = budget_mb * MB / max(1, share) if budget_mb else None
+        self.copies = copies
+        self.bytes_per_record = None
+
+    # Function to call load, which returns a list of records, measuring the memory allocated for them.
+    # Allocations of other threads during the measure can only make the estimate larger.
+    def measure_records(self, load):
+        with _measure_lock:
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                records = load()
+                allocated = tracemalloc.get_traced_memory()[0] - before
+            finally:
+                if started:
+                    tracemalloc.stop()
+        if records:
+            self.bytes_per_record = max(self.bytes_per_record or 0, allocated / len(records))
+        return records
+
+    # Number of records that fit in a batch: unlimited without a budget, a single page until the footprint
+    # has been measured or while the process is already above its budget
+    @property
+    def batch_records(self):
+        if self.budget_bytes is None:
+            return float('inf')
+        if self.bytes_per_record is None:
+            return 0
+        rss = get_rss_mb()
+        if rss is not None and rss > self.budget_mb:
+            return 0
+        return int(self.budget_bytes / (self.bytes_per_record * self.copies))
+
+# Function to read the records of the pages saved in a checkpoint in batches that fit in the memory budget.
+# Pages stay on disk until their batch is processed, so at most one batch is held in memory.
+# convert, if given, turns the records of each page into the representation kept in the batch.
+def iter_record_batches(checkpoint, pages, budget, convert=None):
+    batch = []
+    convert = convert or (lambda records: records)
+    for page in range(1, pages + 1):
+        if budget.bytes_per_record is None:
+            records = budget.measure_records(lambda: convert(checkpoint.load_page(page)))
+        else:
+            records = convert(checkpoint.load_page(page))
+        batch.extend(records)
+        if batch and len(batch) >= budget.batch_records:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
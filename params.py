@@ -2,3 +2,129 @@
 YEARS_OFFSET = 0
 MONTHS_OFFSET = 12
 DAYS_OFFSET = 0
+
+# Carga incremental: solo se escriben los registros nuevos o modificados (según su hash de contenido)
+# en lugar de borrar y recargar toda la ventana. Con False se vuelve al borrado y recarga completos.
+INCREMENTAL_LOAD = True
+# Con carga incremental, eliminamos los gastos e informes de la ventana que ya no entrega la API.
+# Con False solo se informan en el log.
+DELETE_MISSING_RECORDS = True
+
+# Reintentos de las llamadas a las APIs de Rindegastos y SUNAT (backoff exponencial con jitter)
+API_MAX_RETRIES = 5
+API_BASE_DELAY = 1  # en segundos
+API_MAX_DELAY = 60  # en segundos
+API_REQUEST_TIMEOUT = 60  # en segundos
+# Fallos consecutivos tras los cuales se deja de llamar a la API y segundos de espera antes de reintentar
+API_CIRCUIT_FAILURES = 10
+API_CIRCUIT_RESET = 120
+# Concurrencia máxima por API. Se ajusta sola: sube mientras la latencia está bajo el objetivo
+# y se reduce a la mitad ante respuestas 429/5xx.
+RINDEGASTOS_MAX_CONCURRENCY = 4
+SUNAT_MAX_CONCURRENCY = 8
+API_TARGET_LATENCY = 5  # en segundos
+
+# Carpeta donde se guardan las páginas ya descargadas, para retomar una carga interrumpida
+CHECKPOINT_DIR = "checkpoints"
+# Los checkpoints que no se retoman en este plazo se eliminan
+CHECKPOINT_MAX_AGE_DAYS = 3
+
+# Informa en consola la memoria de cada DataFrame antes y después de convertirlo a tipos compactos
+MEMORY_REPORT = True
+
+# Procesos usados para interpretar SunatInfo y ExtraFields en cargas grandes, compartidos por todos los lotes de
+# la ejecución (0 o 1: sin procesos adicionales)
+TRANSFORM_WORKERS = 4
+# Cantidad mínima de registros por proceso; bajo este volumen no compensa iniciar procesos
+TRANSFORM_MIN_RECORDS_PER_WORKER = 5000
+
+# Partición de la ventana de carga de gastos e informes: tramos de PARTITION_MONTHS meses por estado
+PARTITION_MONTHS = 1
+# Los últimos PARTITION_RECENT_DAYS días forman un tramo propio que se actualiza todos los días
+PARTITION_RECENT_DAYS = 30
+# Días de la semana (0 = lunes ... 6 = domingo) en que se actualizan los tramos más antiguos, por ejemplo [6] para
+# hacerlo solo el domingo. Con una lista vacía (por defecto) se actualiza toda la ventana todos los días.
+PARTITION_OLDER_REFRESH_WEEKDAYS = []
+# Tramos que se cargan en paralelo
+PARTITION_WORKERS = 4
+
+# Archivo SQLite local con datos de apoyo (huellas, índices y cachés) que se pueden reconstruir en cualquier momento
+LOCAL_CACHE_PATH = "rindegastos_cache.sqlite"
+
+# Usuarios y políticas cambian poco: si la respuesta de la API es idéntica a la última cargada no se escriben.
+# Pasadas REFERENCE_TABLES_TTL_HOURS horas se vuelven a escribir aunque no hayan cambiado.
+REFERENCE_TABLES = ['rindegastos_usuarios', 'rindegastos_politicas']
+REFERENCE_TABLES_TTL_HOURS = 24 * 7
+
+# Conexiones del pool de base de datos (cada tabla de un lote se escribe en paralelo con su propia conexión)
+DB_POOL_SIZE = 12
+# Segundos que una escritura espera un bloqueo antes de fallar; el lote se revierte y se reintenta en la siguiente carga
+DB_LOCK_TIMEOUT_SECONDS = 300
+
+# Con --profile los scripts guardan aquí un perfil de CPU (.prof) por etapa y un resumen con las funciones
+# y líneas que más tiempo y memoria consumen (las PROFILE_TOP_N primeras)
+PROFILE_DIR = "profiles"
+PROFILE_TOP_N = 30
+
+# Memoria máxima (en MB) que debería usar la carga, repartida entre los tramos que se cargan en paralelo.
+# Las páginas descargadas quedan en disco (CHECKPOINT_DIR) y se procesan en lotes cuyo tamaño se calcula con la
+# memoria medida por registro. Con 0 cada carga se procesa en un solo lote.
+MEMORY_BUDGET_MB = 2048
+# Copias de un lote que conviven en memoria durante su procesamiento (registros, DataFrames y tablas relacionadas)
+MEMORY_WORKING_COPIES = 4
+
+# Guarda el perfil SUNAT de cada proveedor una sola vez por RUC en fil.rindegastos_proveedores_sunat (solo cuando
+# cambia su lastUpdate) y deja en rindegastos_gastos_sunatinfo únicamente los datos del gasto y el RUC.
+# Activar solo después de adaptar fil.sp_actualiza_reporte_rindegastos para que lea el perfil desde la nueva tabla.
+SUNAT_SUPPLIER_DIMENSION = False
+
+# Estado del contribuyente y condición de domicilio de cada RUC aprendidos de SUNAT, válidos por este plazo
+RUC_STATUS_TTL_HOURS = 24
+# Los comprobantes de proveedores en estos estados no se consultan en SUNAT mientras su estado siga vigente
+# en la caché: se registran como 'NO CONSULTADO' con el estado del proveedor y se vuelven a consultar pasados
+# VCP_RECHECK_AFTER_DAYS días (con False solo se consultan al final)
+VCP_SKIP_RUC_STATES = ['BAJA DEFINITIVA', 'NO HALLADO']
+VCP_SKIP_INACTIVE_SUPPLIERS = True
+
+# Orden en que se validan los comprobantes en SUNAT: 'nuevos' (nunca consultados antes que las reconsultas),
+# 'fecha' (más recientes primero), 'monto' (mayor OriginalAmount primero) y 'tipo' (según VCP_DOCUMENT_PRIORITY)
+VCP_PRIORITY = ['nuevos', 'fecha', 'tipo', 'monto']
+VCP_DOCUMENT_PRIORITY = {'FAC': 0, 'BOL': 1}
+# Estados de comprobantes ya consultados que se vuelven a consultar pasados VCP_RECHECK_AFTER_DAYS días
+# (por ejemplo ['NO EXISTE']). Con una lista vacía no se reconsulta ningún comprobante.
+VCP_RECHECK_STATES = []
+VCP_RECHECK_AFTER_DAYS = 7
+# Minutos disponibles para la validación; los comprobantes que no alcanzan a consultarse quedan para la
+# siguiente ejecución (0: sin límite)
+VCP_TIME_BUDGET_MINUTES = 45
+
+# Modo de fil.sp_actualiza_reporte_rindegastos al final de cada carga: 'full' reconstruye todo el reporte e
+# 'incremental' le entrega el run_id para que solo actualice los Ids registrados en fil.rindegastos_cambios.
+# Usar 'incremental' solo cuando el procedimiento acepte el parámetro @run_id.
+REPORT_REFRESH_MODE = 'full'
+
+# Una sola ejecución de cargar_rindegastos a la vez (fil.rindegastos_lease). La ejecución en curso renueva su
+# lease cada LEASE_HEARTBEAT_SECONDS segundos; si deja de hacerlo por LEASE_EXPIRY_SECONDS otra puede tomarlo.
+LEASE_HEARTBEAT_SECONDS = 30
+LEASE_EXPIRY_SECONDS = 180
+# Una segunda ejecución espera a la que está en curso consultando cada LEASE_POLL_SECONDS segundos, hasta
+# LEASE_MAX_WAIT_MINUTES minutos. Con LEASE_REUSE_IN_FLIGHT = True usa el resultado de la ejecución en curso;
+# con False pide una ejecución de seguimiento, que se hace una sola vez para todas las que esperan.
+LEASE_POLL_SECONDS = 15
+LEASE_MAX_WAIT_MINUTES = 180
+LEASE_REUSE_IN_FLIGHT = True
+
+# Listener de notificaciones (escuchar_cambios_rindegastos.py): puerto en que recibe los POST y ventana en segundos
+# en que junta los Ids notificados antes de cargarlos, o antes si se juntan LISTENER_BATCH_MAX Ids
+LISTENER_PORT = 8085
+LISTENER_BATCH_SECONDS = 30
+LISTENER_BATCH_MAX = 200
+
+# Copia local (LOCAL_CACHE_PATH) del detalle de los gastos de los últimos DETAIL_CACHE_DAYS días, que las cargas
+# mantienen al día cuando está activa. Solo la consulta `python detail_cache.py <report_number>` la lee; ninguna
+# carga depende de ella, por lo que viene desactivada
+DETAIL_CACHE_ENABLED = False
+DETAIL_CACHE_DAYS = 120
+
+# Backend de JSON de json_codec: 'auto' usa orjson si está instalado y 'json' fuerza la librería estándar
+JSON_BACKEND = 'auto'
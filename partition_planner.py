@@ -0,0 +1,80 @@
+import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dateutil.relativedelta import relativedelta
+from params import PARTITION_MONTHS, PARTITION_RECENT_DAYS, PARTITION_OLDER_REFRESH_WEEKDAYS, PARTITION_WORKERS
+
+DATE_FORMAT = "%Y-%m-%d"
+
+# A date slice of the load window (both dates included) combined with a status value
+Partition = namedtuple('Partition', ['since', 'until', 'status'])
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, DATE_FORMAT).date()
+
+# Function to get the day after a date, used as exclusive upper bound in SQL filters
+def next_day(value):
+    return (parse_date(value) + datetime.timedelta(days=1)).strftime(DATE_FORMAT)
+
+# Function to split the window into a slice with the most recent days and calendar-aligned slices of
+# PARTITION_MONTHS months before it. Slices are returned from the oldest to the most recent.
+def split_window(since, until, months=PARTITION_MONTHS, recent_days=PARTITION_RECENT_DAYS):
+    since_date = parse_date(since)
+    until_date = parse_date(until)
+    slices = []
+
+    older_until = until_date
+    recent_slice = None
+    if recent_days:
+        recent_since = max(since_date, until_date - datetime.timedelta(days=recent_days - 1))
+        recent_slice = (recent_since, until_date)
+        older_until = recent_since - datetime.timedelta(days=1)
+
+    start = since_date
+    while start <= older_until:
+        end = min(start.replace(day=1) + relativedelta(months=months) - datetime.timedelta(days=1), older_until)
+        slices.append((start, end))
+        start = end + datetime.timedelta(days=1)
+
+    if recent_slice is not None:
+        slices.append(recent_slice)
+    return [(start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)) for start, end in slices]
+
+# Function to decide if a slice is refreshed today: recent slices every day, older slices only on the configured weekdays
+def should_refresh(slice_until, today, recent_days=PARTITION_RECENT_DAYS, older_weekdays=PARTITION_OLDER_REFRESH_WEEKDAYS):
+    today_date = parse_date(today)
+    if parse_date(slice_until) > today_date - datetime.timedelta(days=recent_days):
+        return True
+    return not older_weekdays or today_date.weekday() in older_weekdays
+
+# Function to plan the partitions to load: every refreshed slice of the window combined with every status.
+# Returns the partitions and the refreshed slices.
+def plan_partitions(statuses, since, until, today=None, refresh_all=False, months=PARTITION_MONTHS, recent_days=PARTITION_RECENT_DAYS):
+    today = today or until
+    refreshed_slices = [
+        (slice_since, slice_until)
+        for slice_since, slice_until in split_window(since, until, months, recent_days)
+        if refresh_all or should_refresh(slice_until, today)
+    ]
+    partitions = [
+        Partition(slice_since, slice_until, status)
+        for slice_since, slice_until in refreshed_slices
+        for status in statuses
+    ]
+    return partitions, refreshed_slices
+
+# Function to load the partitions in parallel. Returns {partition: result}.
+def run_partitions(load_function, partitions, workers=PARTITION_WORKERS):
+    if not partitions:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(partitions)))) as executor:
+        results = list(executor.map(load_function, partitions))
+    return dict(zip(partitions, results))
+
+# Function to get the slices whose partitions all loaded successfully
+def successful_slices(refreshed_slices, results):
+    return [
+        (slice_since, slice_until)
+        for slice_since, slice_until in refreshed_slices
+        if all(result for partition, result in results.items() if (partition.since, partition.until) == (slice_since, slice_until))
+    ]
@@ -0,0 +1,162 @@
+import os
+import io
+import sys
+import time
+import datetime
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from params import PROFILE_DIR, PROFILE_TOP_N
+
+# Profiling session of the current run, None when the script was not started with --profile
+_session = None
+_session_lock = threading.Lock()
+# Stage being profiled in each thread; nested stages are counted in the outer one so they do not replace its profiler
+_active = threading.local()
+
+class ProfileSession:
+    def __init__(self, script_name, output_dir=PROFILE_DIR, top_n=PROFILE_TOP_N):
+        self.script_name = script_name
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.started_at = datetime.datetime.now()
+        self.stages = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # Function to get the accumulated results of a stage
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'seconds': 0.0, 'stats': None, 'memory': {}, 'peak': 0, 'unprofiled': 0, 'worker_calls': 0}
+        return self.stages[name]
+
+    # Function to add the results of one execution of a stage
+    def add(self, name, seconds, profile, memory_diff, peak):
+        with _session_lock:
+            stage = self.get_stage(name)
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['peak'] = max(stage['peak'], peak)
+            if profile is None:
+                stage['unprofiled'] += 1
+            elif stage['stats'] is None:
+                stage['stats'] = pstats.Stats(profile)
+            else:
+                stage['stats'].add(profile)
+            for line, size in memory_diff:
+                stage['memory'][line] = stage['memory'].get(line, 0) + size
+
+    # Function to add the profile of a call made in a worker thread on behalf of a stage
+    def add_worker_profile(self, name, profile):
+        with _session_lock:
+            stage = self.get_stage(name)
+            stage['worker_calls'] += 1
+            if stage['stats'] is None:
+                stage['stats'] = pstats.Stats(profile)
+            else:
+                stage['stats'].add(profile)
+
+    # Function to write a .prof file per stage and a text summary with the top functions and allocations
+    def write_report(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"{self.script_name}_{self.started_at.strftime('%Y%m%d_%H%M%S')}")
+        summary = io.StringIO()
+        summary.write(f"Profile of {self.script_name} started at {self.started_at}\n")
+        current, peak = tracemalloc.get_traced_memory()
+        summary.write(f"Traced memory: {current / 1024 ** 2:.1f} MB at the end, {peak / 1024 ** 2:.1f} MB peak\n")
+
+        for name, stage in self.stages.items():
+            summary.write(f"\n{'=' * 80}\nStage {name}: {stage['calls']} calls, {stage['seconds']:.2f} seconds, "
+                          f"{stage['peak'] / 1024 ** 2:.1f} MB peak traced memory\n")
+            if stage['unprofiled']:
+                summary.write(f"{stage['unprofiled']} calls were only timed (another profiler was active)\n")
+            if stage['worker_calls']:
+                summary.write(f"Includes the functions of {stage['worker_calls']} calls made in worker threads\n")
+            if stage['stats'] is not None:
+                stage['stats'].dump_stats(f"{prefix}_{name}.prof")
+                stage['stats'].stream = summary
+                summary.write(f"\nTop {self.top_n} functions by cumulative time:\n")
+                stage['stats'].sort_stats('cumulative').print_stats(self.top_n)
+            top_memory = sorted(stage['memory'].items(), key=lambda item: abs(item[1]), reverse=True)[:self.top_n]
+            if top_memory:
+                summary.write(f"Top {self.top_n} lines by memory allocated during the stage:\n")
+                for line, size in top_memory:
+                    summary.write(f"{size / 1024:>12.1f} KB  {line}\n")
+
+        summary_file = f"{prefix}_summary.txt"
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
+        print(f"Profile written to {summary_file}")
+
+# Function to start profiling the stages of the current run
+def enable_profiling(script_name):
+    global _session
+    _session = ProfileSession(script_name)
+    return _session
+
+# Function to write the profile of the current run, if profiling is enabled
+def write_profile_report():
+    global _session
+    if _session is None:
+        return
+    _session.write_report()
+    tracemalloc.stop()
+    _session = None
+
+# Function to wrap a callable that the current stage runs in worker threads, so its functions are added to the
+# profile of the stage. Before Python 3.12 cProfile only sees the thread that enabled it, and the stage would only
+# show the calling thread waiting for the workers; from 3.12 the profiler of the stage already covers every thread.
+# Memory is traced for every thread by the stage itself.
+def profile_workers(func):
+    session = _session
+    name = getattr(_active, 'stage', None)
+    if session is None or name is None or sys.version_info >= (3, 12):
+        return func
+
+    def profiled(*args, **kwargs):
+        # Calls made in a thread that is already in a stage are covered by its profiler
+        if getattr(_active, 'stage', None) is not None:
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        profile.enable()
+        _active.stage = name
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            _active.stage = None
+            session.add_worker_profile(name, profile)
+    return profiled
+
+# Context manager that measures a stage of the run (fetch, transform, load, sp). Does nothing unless profiling is enabled.
+@contextmanager
+def stage(name):
+    session = _session
+    if session is None or getattr(_active, 'stage', None) is not None:
+        yield
+        return
+
+    snapshot = tracemalloc.take_snapshot()
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows a single active cProfile per process: stages running at the same time in other
+        # threads are only timed and traced
+        profile = None
+    _active.stage = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profile is not None:
+            profile.disable()
+        _active.stage = None
+        memory_diff = [
+            (str(diff.traceback), diff.size_diff)
+            for diff in tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')[:session.top_n]
+        ]
+        session.add(name, seconds, profile, memory_diff, tracemalloc.get_traced_memory()[1])
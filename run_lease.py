@@ -0,0 +1,163 @@
+import os
+import time
+import uuid
+import socket
+import threading
+from params import LEASE_HEARTBEAT_SECONDS, LEASE_EXPIRY_SECONDS, LEASE_POLL_SECONDS, LEASE_MAX_WAIT_MINUTES, LEASE_REUSE_IN_FLIGHT
+
+# Lease that lets a single process run a load at a time. Each lease is a row of LEASE_TABLE:
+# run_id and titular identify the run holding it (NULL when free) and heartbeat is renewed while it runs, so the lease
+# of a process that died expires after LEASE_EXPIRY_SECONDS. Invocations that find it taken either wait for the
+# in-flight run and reuse its result, or leave a request (solicitado) that the holder serves with one follow-up run.
+# The connection factory is received as an argument so this module does not depend on the loaders.
+LEASE_TABLE = 'fil.rindegastos_lease'
+
+CREATE_LEASE_TABLE = f'''
+IF OBJECT_ID('{LEASE_TABLE}', 'U') IS NULL
+    CREATE TABLE {LEASE_TABLE} (
+        nombre VARCHAR(100) NOT NULL PRIMARY KEY,
+        run_id VARCHAR(32) NULL,
+        titular VARCHAR(200) NULL,
+        iniciado DATETIME NULL,
+        heartbeat DATETIME NULL,
+        solicitado DATETIME NULL,
+        terminado DATETIME NULL,
+        terminado_iniciado DATETIME NULL,
+        resultado VARCHAR(20) NULL
+    )
+'''
+
+class LeaseWaitTimeout(Exception):
+    pass
+
+# Function to run a statement on its own connection and return the fetched row (if any) and the affected rows
+def _execute(connection_factory, query, *params, fetch=False):
+    conn = connection_factory()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, *params)
+        row = cursor.fetchone() if fetch else None
+        rowcount = cursor.rowcount
+        conn.commit()
+        return row, rowcount
+    finally:
+        conn.close()
+
+class RunLease:
+    def __init__(self, name, connection_factory):
+        self.name = name
+        self.connection_factory = connection_factory
+        self.run_id = None
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat_thread = None
+        _execute(connection_factory, CREATE_LEASE_TABLE)
+        _execute(
+            connection_factory,
+            f"IF NOT EXISTS (SELECT 1 FROM {LEASE_TABLE} WHERE nombre = ?) INSERT INTO {LEASE_TABLE} (nombre) VALUES (?)",
+            name, name,
+        )
+
+    # Function to read the state of the lease
+    def read(self):
+        row, _ = _execute(
+            self.connection_factory,
+            f"SELECT run_id, titular, iniciado, solicitado, terminado, terminado_iniciado, resultado, GETDATE() FROM {LEASE_TABLE} WHERE nombre = ?",
+            self.name, fetch=True,
+        )
+        keys = ['run_id', 'titular', 'iniciado', 'solicitado', 'terminado', 'terminado_iniciado', 'resultado', 'ahora']
+        return dict(zip(keys, row))
+
+    # Function to take the lease if it is free or its holder stopped sending heartbeats. Returns True if taken.
+    def try_acquire(self):
+        run_id = uuid.uuid4().hex
+        _, rowcount = _execute(
+            self.connection_factory,
+            f'''UPDATE {LEASE_TABLE} SET run_id = ?, titular = ?, iniciado = GETDATE(), heartbeat = GETDATE()
+                WHERE nombre = ? AND (run_id IS NULL OR heartbeat < DATEADD(second, -?, GETDATE()))''',
+            run_id, self.holder, self.name, LEASE_EXPIRY_SECONDS,
+        )
+        if rowcount != 1:
+            return False
+        self.run_id = run_id
+        self._stop_heartbeat.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._heartbeat_thread.start()
+        return True
+
+    def _heartbeat(self):
+        while not self._stop_heartbeat.wait(LEASE_HEARTBEAT_SECONDS):
+            try:
+                _execute(
+                    self.connection_factory,
+                    f"UPDATE {LEASE_TABLE} SET heartbeat = GETDATE() WHERE nombre = ? AND run_id = ?",
+                    self.name, self.run_id,
+                )
+            except Exception as e:
+                print(f"Could not renew the lease {self.name}: {e}")
+
+    # Function to free the lease, recording the result of the run. Returns True if a follow-up run was requested meanwhile.
+    def release(self, result):
+        self._stop_heartbeat.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+        row, _ = _execute(
+            self.connection_factory,
+            f'''UPDATE {LEASE_TABLE} SET run_id = NULL, titular = NULL, terminado = GETDATE(), terminado_iniciado = iniciado, resultado = ?
+                OUTPUT CASE WHEN deleted.solicitado >= deleted.iniciado THEN 1 ELSE 0 END
+                WHERE nombre = ? AND run_id = ?''',
+            result, self.name, self.run_id, fetch=True,
+        )
+        self.run_id = None
+        return bool(row and row[0])
+
+    # Function to leave a request for a follow-up run with the current time of the database
+    def request_follow_up(self):
+        row, _ = _execute(
+            self.connection_factory,
+            f"UPDATE {LEASE_TABLE} SET solicitado = GETDATE() OUTPUT inserted.solicitado WHERE nombre = ?",
+            self.name, fetch=True,
+        )
+        return row[0]
+
+# Function to run func holding the lease name. If another process holds it, the call waits until a run covering
+# this invocation finishes and returns its result instead of doing the same work again:
+# with LEASE_REUSE_IN_FLIGHT the in-flight run is enough, otherwise a single follow-up run serves every waiting call.
+# The run is recorded as 'ok' only if func returns a true value: decorated functions such as those wrapped in
+# log_exceptions return None instead of raising when they fail. Returns the recorded result.
+def run_with_lease(name, func, connection_factory, *args, **kwargs):
+    lease = RunLease(name, connection_factory)
+    deadline = time.monotonic() + LEASE_MAX_WAIT_MINUTES * 60
+    requested_at = None
+
+    while True:
+        if requested_at is not None:
+            state = lease.read()
+            if state['terminado_iniciado'] is not None and state['terminado_iniciado'] >= requested_at:
+                print(f"Reusing the run of {name} finished at {state['terminado']} ({state['resultado']})")
+                return state['resultado']
+
+        if lease.try_acquire():
+            print(f"Lease {name} acquired by {lease.holder} (run {lease.run_id})")
+            while True:
+                result = 'error'
+                try:
+                    if func(*args, **kwargs):
+                        result = 'ok'
+                finally:
+                    follow_up = lease.release(result)
+                if not follow_up or not lease.try_acquire():
+                    return result
+                print(f"Running the follow-up of {name} requested during the previous run")
+
+        if requested_at is None:
+            state = lease.read()
+            if LEASE_REUSE_IN_FLIGHT:
+                requested_at = state['iniciado'] or state['ahora']
+            else:
+                requested_at = lease.request_follow_up()
+            print(f"{name} is already running in {state['titular']}; waiting for it to finish")
+
+        if time.monotonic() > deadline:
+            raise LeaseWaitTimeout(f"{name} is still running after waiting {LEASE_MAX_WAIT_MINUTES} minutes")
+        time.sleep(LEASE_POLL_SECONDS)
@@ -0,0 +1,97 @@
+# In-memory dtypes of each entity loaded from the Rindegastos API.
+# 'category' is used for low-cardinality columns, including the date columns, which have few distinct
+# days per window and are kept as categoricals of their original strings so the values written
+# to SQL Server do not change. Nullable integers are used for counts and Ids that may be missing.
+# Amounts stay float64: float32 does not keep cent precision for large amounts.
+
+expense_schema = {
+    'Status': 'category',
+    'Currency': 'category',
+    'OriginalCurrency': 'category',
+    'Category': 'category',
+    'CategoryCode': 'category',
+    'CategoryGroup': 'category',
+    'CategoryGroupCode': 'category',
+    'TaxName': 'category',
+    'RetentionName': 'category',
+    'Supplier': 'category',
+    'IssueDate': 'category',
+    'IntegrationStatus': 'category',
+    'IntegrationDate': 'category',
+    'ReportId': 'category',
+    'UserId': 'category',
+    'ExpensePolicyId': 'category',
+    'NroFiles': 'Int16',
+    'OriginalAmount': 'float',
+    'ExchangeRate': 'float',
+    'Net': 'float',
+    'Tax': 'float',
+    'OtherTaxes': 'float',
+    'Retention': 'float',
+    'Total': 'float',
+}
+
+report_schema = {
+    'Status': 'category',
+    'CustomStatus': 'category',
+    'Currency': 'category',
+    'SendDate': 'category',
+    'CloseDate': 'category',
+    'EmployeeId': 'category',
+    'EmployeeName': 'category',
+    'ApproverId': 'category',
+    'ApproverName': 'category',
+    'PolicyId': 'category',
+    'PolicyName': 'category',
+    'FundId': 'category',
+    'FundName': 'category',
+    'Integrated': 'category',
+    'IntegrationDate': 'category',
+    'NbrExpenses': 'Int32',
+    'NbrApprovedExpenses': 'Int32',
+    'NbrRejectedExpenses': 'Int32',
+    'ReportNumber': 'Int64',
+    'ReportTotal': 'float',
+    'ReportTotalApproved': 'float',
+}
+
+user_schema = {
+    'Status': 'category',
+    'Role': 'category',
+    'Department': 'category',
+    'CompanyName': 'category',
+}
+
+policy_schema = {
+    'Status': 'category',
+    'Currency': 'category',
+    'Type': 'category',
+}
+
+# The *_Code columns of the extrafields tables are always categoricals
+extrafields_schema = {
+    'Impuesto_Value': 'category',
+    'Centro_Costo_Value': 'category',
+    'Tipo_Documento_Value': 'category',
+    'Sede_Value': 'category',
+    'Sociedad_Value': 'category',
+    'Condicion_Pago_Value': 'category',
+    'Tipo_Rendicion_Value': 'category',
+    'Tipo_Tasa_Value': 'category',
+}
+
+entity_schemas = {
+    'rindegastos_gastos': expense_schema,
+    'rindegastos_informes': report_schema,
+    'rindegastos_usuarios': user_schema,
+    'rindegastos_politicas': policy_schema,
+    'rindegastos_gastos_extrafields': extrafields_schema,
+    'rindegastos_informes_extrafields': extrafields_schema,
+}
+
+# Function to get the schema of a table, including the *_Code columns of the extrafields tables
+def get_schema(target_table, columns=()):
+    schema = dict(entity_schemas.get(target_table, {}))
+    if target_table.endswith('_extrafields'):
+        schema.update({column: 'category' for column in columns if column.endswith('_Code')})
+    return schema
@@ -0,0 +1,171 @@
+import sys
+import json
+import codecs
+import numpy as np
+import pandas as pd
+from schemas import expense_schema, report_schema
+
+# Bytes read from the response at a time while decoding a page
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The items are decoded with the raw_decode of the standard library: the faster backend of json_codec has no
+# incremental API, and decoding the whole page at once would keep every raw record in memory
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+# Incremental decoder of a page of the Rindegastos API. The items of the data_key array are decoded one by one
+# as the response bytes arrive, while the rest of the top-level keys (such as Records) are kept in skeleton.
+class StreamedPage:
+    def __init__(self, chunks, data_key):
+        self.data_key = data_key
+        self.skeleton = {}
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._exhausted = False
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self._buffer, self._pos)
+
+    # Function to append the next chunk of the response to the buffer. Returns False at the end of the response.
+    def _fill(self):
+        if self._exhausted:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._exhausted = True
+            self._buffer += self._text_decoder.decode(b'', final=True)
+            return False
+        self._buffer += self._text_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        return True
+
+    # Function to skip whitespace and return the next character without consuming it
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise self._error("Unexpected end of JSON response")
+
+    def _expect(self, characters):
+        character = self._peek()
+        if character not in characters:
+            raise self._error(f"Expected one of {characters!r}")
+        self._pos += 1
+        return character
+
+    # Function to decode the next value. A value that ends exactly at the end of the buffer is only accepted at the
+    # end of the response, since a number or literal could still continue in the next chunk.
+    def _decode_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+                if end < len(self._buffer) or self._exhausted:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._exhausted:
+                    raise
+            self._fill()
+
+    # Function to drop the part of the buffer already decoded
+    def _compact(self):
+        if self._pos > STREAM_CHUNK_SIZE:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(':')
+            if key == self.data_key and self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode_value()
+                        self._compact()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.skeleton[key] = self._decode_value()
+            if self._expect(',}') == '}':
+                return
+
+# Compact in-memory record of an entity: the fields we load are stored in __slots__ and any other field returned by
+# the API in the extra dictionary, so nothing is lost. Repeated strings of low-cardinality fields are interned.
+class CompactRecord:
+    __slots__ = ('extra',)
+    fields = ()
+    interned_fields = frozenset()
+
+    def __init__(self, data):
+        extra = None
+        for key, value in data.items():
+            if key in self._field_set:
+                if key in self.interned_fields and isinstance(value, str):
+                    value = sys.intern(value)
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self.extra = extra
+
+    def __init_subclass__(cls):
+        cls._field_set = frozenset(cls.fields)
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.fields if hasattr(self, field)}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+EXPENSE_FIELDS = ('Id', 'Note', 'ExtraFields', 'SunatInfo', 'Files') + tuple(expense_schema)
+REPORT_FIELDS = ('Id', 'Title', 'ExtraFields', 'Note') + tuple(report_schema)
+
+class ExpenseRecord(CompactRecord):
+    __slots__ = EXPENSE_FIELDS
+    fields = EXPENSE_FIELDS
+    interned_fields = frozenset(field for field, kind in expense_schema.items() if kind == 'category')
+
+class ReportRecord(CompactRecord):
+    __slots__ = REPORT_FIELDS
+    fields = REPORT_FIELDS
+    interned_fields = frozenset(field for field, kind in report_schema.items() if kind == 'category')
+
+# Record class of each data key; the other entities are small and stay as dictionaries
+RECORD_CLASSES = {
+    'Expenses': ExpenseRecord,
+    'ExpenseReports': ReportRecord,
+}
+
+# Function to convert the records of a page to the compact record of their data key, if it has one
+def to_compact_records(records, data_key):
+    record_class = RECORD_CLASSES.get(data_key)
+    if record_class is None:
+        return records
+    return [record_class(record) for record in records]
+
+# Function to build a DataFrame from compact records or dictionaries. As with a list of dictionaries, a field only
+# becomes a column if some record has it, and records without it get NaN.
+def build_frame(records):
+    if not records or not isinstance(records[0], CompactRecord):
+        return pd.DataFrame(records)
+    columns = {}
+    for field in records[0].fields:
+        values = [getattr(record, field, np.nan) for record in records]
+        if any(hasattr(record, field) for record in records):
+            columns[field] = values
+    extra_fields = dict.fromkeys(key for record in records if record.extra for key in record.extra)
+    for key in extra_fields:
+        columns[key] = [record.extra.get(key, np.nan) if record.extra else np.nan for record in records]
+    return pd.DataFrame(columns)
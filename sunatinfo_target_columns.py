@@ -50,4 +50,9 @@ sunatinfo_target_columns = [
     'voucherIssuanceSystem_nested',
     'zoneCode_nested',
     'zoneType_nested'
-]
\ No newline at end of file
+]
+
+# With SUNAT_SUPPLIER_DIMENSION, rindegastos_gastos_sunatinfo keeps only the columns of the expense and the
+# RUC of the supplier; the rest of the taxpayer profile goes to rindegastos_proveedores_sunat, one row per RUC
+sunat_expense_columns = ['Id', 'ruc', 'documentStatus', 'createdAt', 'informationSource']
+sunat_supplier_columns = ['ruc'] + [column for column in sunatinfo_target_columns if column not in sunat_expense_columns]
@@ -0,0 +1,51 @@
+import pandas as pd
+from sqlalchemy import inspect, text, bindparam
+from db_utils import get_engine, chunk_ids, schema_name
+from sunatinfo_target_columns import sunat_expense_columns, sunat_supplier_columns
+
+# Dimension with the SUNAT taxpayer profile of each supplier, one row per RUC.
+# rindegastos_gastos_sunatinfo then only keeps the columns that belong to the expense and the RUC that references it.
+SUPPLIER_TABLE = 'rindegastos_proveedores_sunat'
+SUPPLIER_KEY = 'ruc'
+# Key of the dimension, used to replace the stored profile of the suppliers written again
+SUPPLIER_UPSERT_KEYS = {SUPPLIER_TABLE: SUPPLIER_KEY}
+
+# Function to split a sunatinfo DataFrame into its expense columns and one row per supplier RUC.
+# When a RUC appears more than once the most recently updated profile is kept.
+def split_sunatinfo_df(df):
+    df = df.copy(deep=False)
+    if 'ruc_nested' in df.columns:
+        df[SUPPLIER_KEY] = df[SUPPLIER_KEY].fillna(df['ruc_nested'])
+    expense_df = df.reindex(columns=sunat_expense_columns)
+
+    suppliers_df = df[df[SUPPLIER_KEY].notna()].reindex(columns=sunat_supplier_columns)
+    suppliers_df[SUPPLIER_KEY] = suppliers_df[SUPPLIER_KEY].astype(str)
+    suppliers_df = suppliers_df.sort_values('lastUpdate', na_position='first', kind='stable')
+    suppliers_df = suppliers_df.drop_duplicates(subset=SUPPLIER_KEY, keep='last')
+    return expense_df, suppliers_df
+
+# Function to load the lastUpdate stored for each RUC as a dictionary {ruc: lastUpdate}
+def load_supplier_versions(rucs, engine=None):
+    engine = engine or get_engine()
+    if not inspect(engine).has_table(SUPPLIER_TABLE, schema=schema_name):
+        return {}
+    query = text(
+        f"SELECT {SUPPLIER_KEY}, lastUpdate FROM {schema_name}.{SUPPLIER_TABLE} WHERE {SUPPLIER_KEY} IN :rucs"
+    ).bindparams(bindparam('rucs', expanding=True))
+    versions = {}
+    with engine.connect() as conn:
+        for chunk in chunk_ids(rucs):
+            versions.update(conn.execute(query, {'rucs': chunk}).fetchall())
+    return versions
+
+# Function to keep only the suppliers that are new or whose lastUpdate changed since they were stored
+def filter_changed_suppliers(suppliers_df, engine=None):
+    if suppliers_df.empty:
+        return suppliers_df
+    versions = load_supplier_versions(suppliers_df[SUPPLIER_KEY].tolist(), engine)
+    changed = pd.Series([
+        ruc not in versions or versions[ruc] != (None if pd.isna(last_update) else last_update)
+        for ruc, last_update in zip(suppliers_df[SUPPLIER_KEY], suppliers_df['lastUpdate'])
+    ], index=suppliers_df.index, dtype=bool)
+    print(f"{SUPPLIER_TABLE}: {int(changed.sum())} new or updated, {int((~changed).sum())} unchanged suppliers.")
+    return suppliers_df[changed]
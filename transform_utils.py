@@ -0,0 +1,148 @@
+import math
+import atexit
+import threading
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sunatinfo_target_columns import sunatinfo_target_columns
+from json_codec import loads
+from params import TRANSFORM_WORKERS, TRANSFORM_MIN_RECORDS_PER_WORKER
+
+# Functions in this module only use the standard library, so worker processes start quickly.
+# Each one receives a shard of (Id, value) pairs and returns a columnar chunk {column: [values]}.
+
+def remove_accents_and_spaces(input_str):
+    nfkd_form = unicodedata.normalize('NFKD', input_str)
+    without_accents = ''.join([c for c in nfkd_form if not unicodedata.combining(c)])
+    return without_accents.replace(' ', '_')
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+# Function to flatten the SunatInfo of an expense, including the fields of its extractedData with the '_nested' suffix
+def parse_sunatinfo(sunat_info):
+    row = {}
+    if not isinstance(sunat_info, dict):
+        return row
+    row.update(sunat_info)
+    if 'extractedData' in sunat_info:
+        try:
+            extracted_data = loads(sunat_info['extractedData'])
+            if isinstance(extracted_data, dict):
+                nested_data = dict(extracted_data)
+                # Fields that are not at the first level are taken from 'data'
+                if isinstance(extracted_data.get('data'), dict):
+                    for key, value in extracted_data['data'].items():
+                        nested_data.setdefault(key, value)
+            else:
+                # extractedData is sometimes encoded twice
+                nested_data = loads(extracted_data)['data']
+        except Exception as e:
+            print(f"Error processing 'extractedData': {e}")
+            nested_data = {}
+        for key, value in nested_data.items():
+            row[f"{key}_nested"] = value
+    return row
+
+# Function to parse a shard of SunatInfo values. Rows without any value are dropped.
+def parse_sunatinfo_records(records):
+    target_columns = [column for column in sunatinfo_target_columns if column != 'Id']
+    columns = {column: [] for column in sunatinfo_target_columns}
+    for record_id, sunat_info in records:
+        row = parse_sunatinfo(sunat_info)
+        if all(is_null(value) for value in row.values()):
+            continue
+        columns['Id'].append(record_id)
+        for column in target_columns:
+            columns[column].append(row.get(column))
+    return columns
+
+# Function to parse a shard of ExtraFields lists into the Value and Code columns of the desired fields
+def parse_extrafields_records(records, desired_fields):
+    columns = {'Id': []}
+    for field in desired_fields:
+        cleaned_field = remove_accents_and_spaces(field)
+        columns[f"{cleaned_field}_Value"] = []
+        columns[f"{cleaned_field}_Code"] = []
+
+    for record_id, extra_fields in records:
+        if not isinstance(extra_fields, list):
+            extra_fields = []
+        row_values = {field['Name']: field['Value'] for field in extra_fields if field['Name'] in desired_fields}
+        columns['Id'].append(record_id)
+        for field in desired_fields:
+            cleaned_field = remove_accents_and_spaces(field)
+            if field in row_values:
+                value = row_values[field]
+                code = next((f['Code'] for f in extra_fields if f['Name'] == field), None)
+            else:
+                value = None
+                code = None
+            # Replace empty strings with NaN
+            columns[f"{cleaned_field}_Value"].append(float('nan') if value == '' else value)
+            columns[f"{cleaned_field}_Code"].append(float('nan') if code == '' else code)
+    return columns
+
+# Function to split the records into contiguous Id ranges of similar size
+def shard_by_id(records, shards):
+    records = sorted(records, key=lambda record: record[0])
+    size = math.ceil(len(records) / shards)
+    return [records[start:start + size] for start in range(0, len(records), size)]
+
+# Function to concatenate columnar chunks, filling with None the columns missing in a chunk
+def merge_columns(chunks):
+    merged = {}
+    total_rows = 0
+    for chunk in chunks:
+        chunk_rows = len(chunk['Id']) if 'Id' in chunk else 0
+        for column in chunk:
+            if column not in merged:
+                merged[column] = [None] * total_rows
+        for column, values in merged.items():
+            values.extend(chunk.get(column, [None] * chunk_rows))
+        total_rows += chunk_rows
+    return merged
+
+# A single pool of TRANSFORM_WORKERS processes is shared by every batch and thread of the process. It is created
+# on first use and shut down when the process exits, so the workers (and, on Windows, the import of the main
+# script in each of them) are only started once per run.
+_pool = None
+_pool_lock = threading.Lock()
+
+# Function to get the shared pool of worker processes
+def get_transform_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=TRANSFORM_WORKERS)
+        return _pool
+
+# Function to shut down the shared pool of worker processes
+def shutdown_transform_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
+
+atexit.register(shutdown_transform_pool)
+
+# Function to run a parsing function over the records, in worker processes when there are enough records
+def run_transform(parse_function, records, *args, workers=TRANSFORM_WORKERS):
+    global _pool
+    records = list(records)
+    workers = min(workers, TRANSFORM_WORKERS, len(records) // TRANSFORM_MIN_RECORDS_PER_WORKER)
+    if workers <= 1:
+        return parse_function(records, *args)
+
+    shards = shard_by_id(records, workers)
+    pool = get_transform_pool()
+    try:
+        chunks = list(pool.map(parse_function, shards, *[[arg] * len(shards) for arg in args]))
+    except BrokenProcessPool:
+        # A worker died; the next call starts a new pool
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+    return merge_columns(chunks)